@@ -1,192 +1,129 @@
 '''
 Take real time data from Bixi json
 
-Save data in severals .csv
+Save data in long format (time, station_id, bikes, ebikes, docks) in severals .parquet
+Only the stations that changed are saved, with a keyframe of all the stations every hour
 '''
 
+import asyncio
 import json
 import os
-from queue import Queue
-import threading
 import time
-import pandas as pd
-import urllib.request
 import datetime as dt
+import numpy as np
+from sniffer_collector import Feed, GBFSCollector
+from sniffer_parsing import STATION_IDS_FILE, StationIds, decode_station_status
+from sniffer_storage import DeltaEncoder, SnapshotWriter
 
-# Number of collected data to create a .csv
-NB_ROWS_CSV = 100
+# Number of rows (one per station and collect) written at once in a row group
+ROW_GROUP_SIZE = 100_000
 
-# Get new data every 20 seconds
+# Number of row groups to create a .parquet
+ROW_GROUPS_PER_FILE = 24
+
+# Close a .parquet every 5 minutes at most, so the app can show the live availability
+MAX_FILE_AGE = 300
+
+# Store all the stations every 180 collects (1 hour), else only the stations that changed
+KEYFRAME_EVERY = 180
+
+# Get new data every 20 seconds at most (or when the data expires, see GBFS ttl)
 TIME_BETWEEN_COLLECT = 20
 
 # Collect time. If negative or null, infinite collect
 COLLECT_TIME = 0
 
-# CSV Prefix
+# Result folder
 RESULT_PATH = "Sniffer Data"
 
+# Bixi GBFS feeds
+STATION_STATUS_URL = "https://gbfs.velobixi.com/gbfs/fr/station_status.json"
+STATION_INFORMATION_URL = "https://gbfs.velobixi.com/gbfs/fr/station_information.json"
+
 
 class BixiSniffer:
-    def __init__(self, result_path: str, nb_rows_csv: int, time_between_collect: int, collect_time: int) -> None:
+    def __init__(self, result_path: str, row_group_size: int, row_groups_per_file: int, time_between_collect: int, collect_time: int,
+                 keyframe_every: int = KEYFRAME_EVERY, max_file_age: float = MAX_FILE_AGE, station_status_url: str = STATION_STATUS_URL, station_information_url: str = STATION_INFORMATION_URL) -> None:
         self.result_path = result_path
-        if not self.result_path in os.listdir():
-            os.makedirs(os.path.join(self.result_path, "Available Bikes"))
-            os.mkdir(os.path.join(self.result_path, "Available eBikes"))
 
-        self.nb_rows_csv = nb_rows_csv
-        self.nb_csv = 1
+        # Append-only storage, memory does not grow with the collect time
+        self.writer = SnapshotWriter(os.path.join(
+            self.result_path, "Snapshots"), row_group_size, row_groups_per_file, max_file_age=max_file_age)
+        # Change data capture: only the stations that changed are stored
+        self.encoder = DeltaEncoder(keyframe_every)
+        # Integers of the GBFS station_ids, the same in all the snapshots
+        self.station_ids = StationIds(os.path.join(self.result_path, STATION_IDS_FILE))
 
         self.time_between_collect = time_between_collect
         self.collect_time = collect_time
 
-        # Manage thread sync with a queue
-        self.nb_rows_queue = Queue()
-        self.sniffer_on = False
-        self.get_and_save_thread = threading.Thread(
-            target=self.get_and_save_data, args=(self.nb_rows_queue,), daemon=True)
-        self.sniffer_thread = threading.Thread(target=self.sniffer)
-
-        # Init dataframe columns
-        df_bikes, df_ebikes = self.get_data()
-        self.df_available_bikes_original = pd.DataFrame(
-            columns=df_bikes.columns)
-        self.df_available_ebikes_original = pd.DataFrame(
-            columns=df_ebikes.columns)
-
-        self.df_available_bikes = self.df_available_bikes_original.copy()
-        self.df_available_ebikes = self.df_available_ebikes_original.copy()
+        # Both feeds are polled on one event loop, the status when it expires
+        self.collector = GBFSCollector([
+            Feed("station_status", station_status_url,
+                 self.save_station_status, min_interval=time_between_collect),
+            Feed("station_information", station_information_url,
+                 self.save_station_information, min_interval=time_between_collect),
+        ])
+        self.nb_collects = 0
         print("Press CTRL+C to abord acquisition (will save incomplete data) ...")
 
-    def query_station_status(self, bixi_url="https://gbfs.velobixi.com/gbfs/fr/station_status.json"):
-        with urllib.request.urlopen(bixi_url) as data_url:
-            data = json.loads(data_url.read().decode())
-
-        df = pd.DataFrame(data['data']['stations'])
-        # drop inactive stations
-        # TODO Check if necessary, problems with columns if a merge is needed ???
-        df = df[df.is_renting == 1]
-        df = df[df.is_returning == 1]
-        df = df.drop_duplicates(['station_id', 'last_reported'])
-        df.last_reported = df.last_reported.map(
-            lambda x: dt.datetime.utcfromtimestamp(x))
-        df['time'] = data['last_updated']
-        df.time = df.time.map(lambda x: dt.datetime.utcfromtimestamp(x))
-        df = df.set_index('time')
-        # Add convert to Montreal time
-        df.index = df.index.tz_localize('UTC').tz_convert('America/Montreal')
-
-        return df
-
-    def get_data(self):
+    def parse_station_status(self, data: dict):
         '''
-        Get data and return two dataframes:
-            - one for available bikes
-            - one for available ebikes
+        Returns the active stations of the payload as typed numpy columns
+        (time, station_id, bikes, ebikes, docks, last_reported), times in UTC
         '''
-        df = self.query_station_status()
-        df_bikes = pd.pivot_table(
-            df, columns='station_id', index='time', values='num_bikes_available')
-        df_ebikes = pd.pivot_table(
-            df, columns='station_id', index='time', values='num_ebikes_available')
-        return df_bikes, df_ebikes
-
-    def get_and_save_data(self, nb_rows_queue: Queue):
+        return decode_station_status(data, self.station_ids)
+
+    def save_station_status(self, feed: Feed, data: dict):
         '''
-        Get each data, accumulate and save to .csv
+        Append a new station status to the .parquet storage (one row per station
+        that changed, all the stations for a keyframe)
         '''
-        while self.sniffer_on:
-            # Wait for nb_rows
-            nb_rows = nb_rows_queue.get()
-
-            # Get data
-            df_bikes, df_ebikes = self.get_data()
-
-            # Concat dataframe
-            self.df_available_bikes = pd.concat(
-                [self.df_available_bikes, df_bikes])
-            self.df_available_ebikes = pd.concat(
-                [self.df_available_ebikes, df_ebikes])
-
-            # Save csv if nb_rows is enough
-            if nb_rows == self.nb_rows_csv:
-                self.save_to_csv()
-
-                # Reset DataFrames
-                self.df_available_bikes = self.df_available_bikes_original.copy()
-                self.df_available_ebikes = self.df_available_ebikes_original.copy()
-        print("Get and save data thread stopped")
-
-    def save_to_csv(self):
+        columns = self.parse_station_status(data)
+        values = np.stack([columns['bikes'], columns['ebikes'], columns['docks']], axis=1)
+        keep, keyframe = self.encoder.encode(columns['station_id'], values, columns['last_reported'])
+
+        self.writer.append(
+            time=columns['time'],
+            station_id=columns['station_id'][keep],
+            bikes=values[keep, 0],
+            ebikes=values[keep, 1],
+            docks=values[keep, 2],
+            last_reported=columns['last_reported'][keep],
+            keyframe=keyframe)
+
+        self.nb_collects += 1
+        current_time = time.perf_counter()-self.start_time
+        # Print information
+        print(
+            f"Time since beggining : {dt.timedelta(seconds=int(current_time))} | Current number of parquet files : {self.writer.nb_files} | Number of collects : {self.nb_collects}")
+
+    def save_station_information(self, feed: Feed, data: dict):
         '''
-        Save dataframes to csv
-        Increments self.nb_csv
+        Save the last station information (name, location, capacity) when it changes
         '''
-        self.df_available_bikes.to_csv(os.path.join(
-            self.result_path, "Available Bikes", f"Available_Bikes_{str(self.nb_csv).zfill(3)}.csv"))
-        self.df_available_ebikes.to_csv(os.path.join(
-            self.result_path, "Available eBikes", f"Available_eBikes_{str(self.nb_csv).zfill(3)}.csv"))
-        self.nb_csv += 1
+        path = os.path.join(self.result_path, "station_information.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
 
     def start_sniffer(self):
+        print("Starting Bixi Sniffer..")
+        self.start_time = time.perf_counter()
         try:
-            self.sniffer_on = True
-            # Start loop thread and get_and_save thread
-            self.sniffer_thread.start()
-            self.get_and_save_thread.start()
-
-            while self.sniffer_on:
-                time.sleep(0.1)
-
+            asyncio.run(self.collector.run(self.collect_time))
         except KeyboardInterrupt:
-            # Stop threads and save last data if not empty
-            self.sniffer_on = False
+            # Stop collect and save last data
+            pass
         finally:
-            if len(self.df_available_bikes):
-                self.save_to_csv()
-
-    def sniffer(self):
-        nb_rows = 0
-        start_time = time.perf_counter()
-        print("Starting Bixi Sniffer..")
-
-        while self.sniffer_on:
-            # Loop that manage nb_rows and therefore the thread and saving to csv
-            nb_rows += 1
-
-            # Put nb_rows to queue: execute func in thread
-            self.nb_rows_queue.put(nb_rows)
-
-            current_time = time.perf_counter()-start_time
-            # Print information
-            print(
-                f"Time since beggining : {dt.timedelta(seconds=int(current_time))} | Current number of csv files : {self.nb_csv} | Number of rows for current csv : {nb_rows}")
-
-            # Reset nb_rows if equals to desired rows number is csv
-            if nb_rows == self.nb_rows_csv:
-                nb_rows = 0
-
-            # Stop condition if collect_time > 0
-            if self.collect_time > 0:
-                print(
-                    f"Remaining time: {int(self.collect_time-current_time)} s")
-                if current_time > self.collect_time:
-                    break
-
-            # Wait for new collect
-            time.sleep(self.time_between_collect)
-
-        self.sniffer_on = False
-        print("Sniffer stopped successfully !")
+            self.writer.close()
+            print(f"Requests: {[feed.stats() for feed in self.collector.feeds]}")
+            print("Sniffer stopped successfully !")
 
 
 if __name__ == "__main__":
-    sniffer = BixiSniffer(RESULT_PATH, NB_ROWS_CSV,
+    sniffer = BixiSniffer(RESULT_PATH, ROW_GROUP_SIZE, ROW_GROUPS_PER_FILE,
                           TIME_BETWEEN_COLLECT, COLLECT_TIME)
 
-    # Test initializing dataframes
-
-    # print(sniffer.df_available_bikes_original)
-    # print(sniffer.df_available_ebikes_original)
-
     # Test sniffing
     sniffer.start_sniffer()
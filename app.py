@@ -1,165 +1,559 @@
 from itertools import count
 import json
-from dash import Dash, html, dcc, Input, Output, ctx
-import pandas as pd
-import plotly.express as px
+import os
+import threading
+from typing import TYPE_CHECKING
+from dash import Dash, html, dcc, Input, Output, ctx, no_update
+import numpy as np
 import plotly.graph_objects as go
-from app_figures import Data, Figures, MONTHS
+from app_cache import FigureCache
+from app_metrics import METRICS, stage, timed_callback
+
+# The data modules (app_figures, data_ingest and pandas) are imported by load_data, in
+# a thread when the app starts lazily. plotly.express is imported by the first stations
+# map and app_live (pyarrow) only if there are snapshots of the sniffer
+if TYPE_CHECKING:
+    from app_figures import Data
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 
+# Max size of the serialized figures kept in the caches of the callbacks
+MAP_CACHE_BYTES = 64 * 1024 * 1024
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024
+
+# The viewport of the stations map is rounded (degrees) to cache the maps of close viewports
+VIEWPORT_STEP = 0.01
+
+# Time between two updates of the live availability map (ms), the sniffer collects every 20 s
+LIVE_INTERVAL = 20 * 1000
+
+# Time between two checks of the data loading by a page served before the data (ms)
+LOADING_INTERVAL = 1000
+
+# Default folders, copies of data_years.DATA_PATH and app_live.SNIFFER_PATH so app.py
+# starts without importing them: keep them in sync
+DATA_PATH = "data"
+SNIFFER_PATH = "Sniffer Data"
+
 
 class DashApp:
-    def __init__(self) -> None:
-        # Import Bixi Data
-        self.data = Data()
+    def __init__(self, prewarm: bool = True, live_path: str = SNIFFER_PATH, data_path: str = DATA_PATH, watch: bool = True, lazy: bool = False) -> None:
+        """
+        With lazy, the data is loaded in a thread: the server starts at once and the
+        pages served meanwhile show a loading state until the data is ready. Not with
+        a WSGI server with --preload (the thread is not in the forked workers)
+        """
+        # Cache of the figures by (begin_period, end_period, best_idxs, ...) and by stations
+        self.map_cache = FigureCache("stations_map", MAP_CACHE_BYTES)
+        self.history_cache = FigureCache("station_deplacement", HISTORY_CACHE_BYTES)
 
-        # Create figures
-        self.fig_creator = Figures()
+        # Set by load_data, the callbacks wait for the data (see the data property)
+        self.data_path = data_path
+        self.prewarm = prewarm
+        self.fig_creator = None
+        self._data = None
+        self._data_ready = threading.Event()
+        self._modules_imported = threading.Event()
+        self.load_error = None
 
-        self.app = Dash(__name__)
+        # New trips files in data_path are loaded without restarting the app
+        self.watch = watch
+        self.watcher = None
 
-        self.app.layout = html.Div(
-            [
-                html.Div([html.H1("Bixi Visualisation")], className="banner"),
-                html.Div(
-                    [
-                        html.H3("Bixi Map - Deplacement Analysis in year 2021"),
-                        html.Div(
-                            [
-                                html.Div(
-                                    [
-                                        html.P("Month Timeline for 2021"),
-                                        dcc.RangeSlider(
-                                            min=self.data.min_month_idx,
-                                            max=self.data.max_month_idx,
-                                            step=1,
-                                            value=[
-                                                self.data.min_month_idx,
-                                                self.data.max_month_idx,
-                                            ],
-                                            marks={
-                                                idx + 1: MONTHS[idx]
-                                                for idx in range(
-                                                    self.data.min_month_idx - 1,
-                                                    self.data.max_month_idx,
-                                                )
-                                            },
-                                            id="stations_map_slider_timeline",
-                                        ),
-                                    ],
-                                    id="div_slider_timeline",
-                                    className="six columns",
-                                ),
-                                html.Div(
-                                    [
-                                        html.P("How many best stations would you see?"),
-                                        dcc.Slider(
-                                            min=1,
-                                            max=len(self.data.bixi_stations),
-                                            step=None,
-                                            value=len(self.data.bixi_stations),
-                                            id="stations_map_slider_best",
-                                        ),
-                                    ],
-                                    id="div_slider_best_bixis",
-                                    className="six columns",
-                                ),
-                            ],
-                            className="row",
-                        ),
-                    ]
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                dcc.Graph(id="stations_map"),
-                            ],
-                            # className="seven columns",
-                        ),
-                        html.Div(
-                            [
-                                html.H5(
-                                    "Click or select stations on the map to show deplacement over year"
-                                ),
-                                dcc.Graph(id="station_deplacement_figure"),
-                            ],
-                            # className="five columns",
-                        ),
-                    ],
-                    # className="row",
-                ),
-                html.Div(
-                    [
-                        html.H5(id="station_deplacement_h5"),
-                        dcc.Graph(id="station_deplacement_map"),
-                    ]
-                ),
-                html.P(id="dummy"),
-            ]
+        # Live availability if the sniffer saved snapshots in live_path
+        self.live_path = live_path
+        self.live = None
+        has_live = live_path is not None and os.path.isdir(os.path.join(live_path, "Snapshots"))
+
+        if lazy:
+            threading.Thread(target=self.load_data_in_background, daemon=True).start()
+        else:
+            self.load_data(has_live)
+
+        # The components of the data are added to the page when it is loaded
+        self.app = Dash(__name__, suppress_callback_exceptions=True)
+        # Latency histograms of the callbacks at /metrics if BIXI_METRICS is set
+        METRICS.register(self.app.server, self.cache_stats)
+        self.app.server.before_request(self.before_request)
+
+        # A function, so the timeline of a new page follows the data after a reload
+        self.app.layout = self.serve_layout
+
+        # Callback of the pages served before the data is loaded
+        @self.app.callback(
+            Output("page_content", "children"),
+            Output("loading_interval", "disabled"),
+            Input("loading_interval", "n_intervals"),
+            prevent_initial_call=True,
+        )
+        def update_page_content(n_intervals):
+            if self._data_ready.is_set():
+                return self.data_layout(), True
+            if self.load_error is not None:
+                return self.loading_layout(), True
+            return no_update, no_update
+
+        # Callback for the viewport of the station map (zoom and pan)
+        @self.app.callback(
+            Output("stations_map_viewport", "data"),
+            Input("stations_map", "relayoutData"),
+            prevent_initial_call=True,
         )
+        @timed_callback("update_viewport")
+        def update_viewport(relayoutData):
+            bounds = self.viewport_bounds(relayoutData)
+            return no_update if bounds is None else bounds
 
-        # Callback for the station map and the timeline and best sliders
+        # Callback for the station map, the timeline and best sliders and the viewport
         @self.app.callback(
             Output("stations_map", "figure"),
             Output("stations_map_slider_best", "max"),
             Input("stations_map_slider_timeline", "value"),
             Input("stations_map_slider_best", "value"),
+            Input("stations_map_viewport", "data"),
+            Input("stations_map_days", "value"),
+            Input("stations_map_hours", "value"),
         )
-        def update_figure(timeline, best_idxs):
-            begin_month = timeline[0]
-            end_month = timeline[1]
-
-            filtered_df = self.data.data_stations_2021[
-                (self.data.data_stations_2021["Month"] >= begin_month)
-                & (self.data.data_stations_2021["Month"] <= end_month)
-            ]
-
-            count_df = self.data.get_deplacements_count(filtered_df)
-            count_df.sort_values(by="nb_trajets", ascending=False, inplace=True)
-
-            return self.fig_creator.create_stations_map(count_df[:best_idxs]), len(
-                count_df
+        @timed_callback("update_figure")
+        def update_figure(timeline, best_idxs, viewport, days, hours):
+            key = (
+                timeline[0],
+                timeline[1],
+                best_idxs,
+                viewport and tuple(viewport),
+            ) + self.time_filter_key(days, hours)
+            fig, nb_stations = self.map_cache.get_or_create(
+                key, lambda: self.create_stations_map(key)
             )
+            return fig, nb_stations
 
         # Callback to update station deplacement figure when selected/clicked station on map
         @self.app.callback(
             Output("station_deplacement_figure", "figure"),
             Input("stations_map", "selectedData"),
+            Input("stations_map_days", "value"),
+            Input("stations_map_hours", "value"),
         )
-        def update_station_deplacement_by_months(selectedData):
+        @timed_callback("update_station_deplacement_by_months")
+        def update_station_deplacement_by_months(selectedData, days, hours):
             if selectedData is None:
                 return go.Figure()
-            print(selectedData)
-            stations_lon_lat = [[pt["lon"], pt["lat"]] for pt in selectedData["points"]]
-            stations_names = [pt["hovertext"] for pt in selectedData["points"]]
-            # If custom_data=["pk"] is specified for figure:
-            stations_id = [pt["customdata"][0] for pt in selectedData["points"]]
-            dfs_dict = self.data.get_stations_deplacement(stations_names)
-            # print(dfs_dict)
-            fig = self.fig_creator.create_stations_deplacement_history(dfs_dict)
-            return fig
-        
-        # # Callback to update station deplacement map when clicked station on map
-        # # TODO: Optimize because its lagging a lot...
-        # @self.app.callback(
-        #     Output("station_deplacement_map", "figure"),
-        #     Output("station_deplacement_h5","children"),
-        #     Input("stations_map", "clickData"),
-        # )
-        # def update_station_deplacement_by_months(clickData):
-        #     if clickData is None:
-        #         return go.Figure(), "No station clicked"
-        #     print(clickData)
-        #     station_name = clickData["points"][0]["hovertext"]
-        #     h5_text=f"Clicked station: {station_name}"
-        #     fig = self.fig_creator.create_stations_deplacement_map(self.data.deplacements,station_name)
-        #     return fig, h5_text
-        
+            # custom_data=["pk"] is specified for the stations map (-1 for a cluster)
+            stations_id = tuple(
+                sorted({pt["customdata"][0] for pt in selectedData["points"]} - {-1})
+            )
+            if not stations_id:
+                return go.Figure()
+            key = (stations_id,) + self.time_filter_key(days, hours)
+            return self.history_cache.get_or_create(
+                key, lambda: self.create_stations_deplacement_history(*key)
+            )
         
+        # Callback to update station deplacement map when clicked station on map
+        @self.app.callback(
+            Output("station_deplacement_map", "figure"),
+            Output("station_deplacement_h5","children"),
+            Input("stations_map", "clickData"),
+        )
+        @timed_callback("update_station_deplacement_map")
+        def update_station_deplacement_map(clickData):
+            if clickData is None:
+                return go.Figure(), "No station clicked"
+            station_name = clickData["points"][0]["hovertext"]
+            station_id = clickData["points"][0]["customdata"][0]
+            if station_id < 0:
+                return go.Figure(), f"Clicked cluster: {station_name}, zoom to show its stations"
+            h5_text=f"Clicked station: {station_name}"
+            with stage("data"):
+                flows, min_max_nb = self.data.get_station_flows(station_id)
+            with stage("figure"):
+                fig = self.fig_creator.create_stations_deplacement_map(flows, min_max_nb)
+            return fig, h5_text
+
+        if has_live:
+            self.add_live_callbacks()
+
+    @property
+    def data(self) -> "Data":
+        """
+        Data of the app, waits for load_data (callbacks of a page served meanwhile)
+        """
+        self._data_ready.wait()
+        return self._data
+
+    def load_data(self, has_live: bool = None):
+        """
+        Import the data modules and load the data, the figures of the layout and the
+        live availability
+        """
+        try:
+            from app_figures import Data, Figures
+            from data_ingest import DataWatcher
+        finally:
+            self._modules_imported.set()
+
+        self.fig_creator = Figures()
+        if has_live is None:
+            has_live = self.live_path is not None and os.path.isdir(
+                os.path.join(self.live_path, "Snapshots")
+            )
+        if has_live:
+            # Only the live availability needs pyarrow
+            from app_live import LiveAvailability
+
+            self.live = LiveAvailability(self.live_path)
+
+        self.set_data(Data(self.data_path))
+
+        if self.watch:
+            self.watcher = DataWatcher(self.data_path, self.reload_data)
+
+    def load_data_in_background(self):
+        try:
+            self.load_data()
+        except Exception as e:  # shown by the loading page
+            self.load_error = repr(e)
+            print(f"Error while loading the data: {e!r}")
+
+    def before_request(self):
+        # Plotly serializes the responses with pandas if it is in sys.modules: wait
+        # for the imports of the loading thread (not for the data)
+        self._modules_imported.wait()
+        # Started by the first request of each process (WSGI workers are forked)
+        if self.watcher is not None:
+            self.watcher.start()
+
+    def serve_layout(self):
+        ready = self._data_ready.is_set()
+        return html.Div(
+            [
+                html.Div([html.H1("Bixi Visualisation")], className="banner"),
+                html.Div(
+                    self.data_layout() if ready else self.loading_layout(),
+                    id="page_content",
+                ),
+                dcc.Interval(
+                    id="loading_interval", interval=LOADING_INTERVAL, disabled=ready
+                ),
+            ]
+        )
+
+    def loading_layout(self):
+        if self.load_error is not None:
+            return [html.H3("The data could not be loaded"), html.P(self.load_error)]
+        return [
+            html.H3("Preparing the data..."),
+            html.P("The page is updated when the data is ready"),
+        ]
+
+    def data_layout(self):
+        """
+        Components of the data (sliders, maps and figures) and of the live availability
+        """
+        from data_years import DAYS, NB_HOURS
+
+        # Same data for the whole layout, even if it is reloaded meanwhile
+        data = self.data
+        return [
+            html.Div(
+                [
+                    html.H3(
+                        "Bixi Map - Deplacement Analysis from "
+                        f"{data.years[0]} to {data.years[-1]}"
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.P("Month Timeline"),
+                                    dcc.RangeSlider(
+                                        min=data.min_period_idx,
+                                        max=data.max_period_idx,
+                                        step=1,
+                                        # Only the last year is loaded at start
+                                        value=[
+                                            data.year_month_to_period(
+                                                data.last_year, 1
+                                            ),
+                                            data.max_period_idx,
+                                        ],
+                                        marks=self.timeline_marks(data),
+                                        id="stations_map_slider_timeline",
+                                    ),
+                                ],
+                                id="div_slider_timeline",
+                                className="six columns",
+                            ),
+                            html.Div(
+                                [
+                                    html.P("How many best stations would you see?"),
+                                    dcc.Slider(
+                                        min=1,
+                                        max=len(data.bixi_stations),
+                                        step=None,
+                                        value=len(data.bixi_stations),
+                                        id="stations_map_slider_best",
+                                    ),
+                                ],
+                                id="div_slider_best_bixis",
+                                className="six columns",
+                            ),
+                        ],
+                        className="row",
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.P("Days of the week"),
+                                    dcc.Checklist(
+                                        options=[
+                                            {"label": day[:3], "value": idx}
+                                            for idx, day in enumerate(DAYS)
+                                        ],
+                                        value=list(range(len(DAYS))),
+                                        inline=True,
+                                        id="stations_map_days",
+                                    ),
+                                ],
+                                id="div_days",
+                                className="six columns",
+                            ),
+                            html.Div(
+                                [
+                                    html.P("Start hour"),
+                                    dcc.RangeSlider(
+                                        min=0,
+                                        max=NB_HOURS,
+                                        step=1,
+                                        value=[0, NB_HOURS],
+                                        marks={
+                                            hour: f"{hour}h"
+                                            for hour in range(0, NB_HOURS + 1, 3)
+                                        },
+                                        id="stations_map_hours",
+                                    ),
+                                ],
+                                id="div_hours",
+                                className="six columns",
+                            ),
+                        ],
+                        className="row",
+                    ),
+                ]
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            dcc.Graph(id="stations_map", figure=self.stations_map),
+                            dcc.Store(id="stations_map_viewport"),
+                        ],
+                        # className="seven columns",
+                    ),
+                    html.Div(
+                        [
+                            html.H5(
+                                "Click or select stations on the map to show deplacement over year "
+                                f"{data.last_year}"
+                            ),
+                            dcc.Graph(id="station_deplacement_figure"),
+                        ],
+                        # className="five columns",
+                    ),
+                ],
+                # className="row",
+            ),
+            html.Div(
+                [
+                    html.H5(id="station_deplacement_h5"),
+                    dcc.Graph(id="station_deplacement_map"),
+                ]
+            ),
+            html.P(id="dummy"),
+        ] + self.live_layout()
+
+    def set_data(self, data: "Data"):
+        """
+        Use data in the callbacks: the base stations map of the layout is created
+        with all the stations of the last year, the callback only sends patches of
+        the markers in the viewport
+        """
+        points, _ = data.get_map_points(
+            data.year_month_to_period(data.last_year, 1),
+            data.max_period_idx,
+            len(data.bixi_stations),
+        )
+        self.stations_map = self.fig_creator.create_stations_map(points)
+        # The callbacks running during the swap keep the data they started with
+        self._data = data
+        self._data_ready.set()
+        self.map_cache.clear()
+        self.history_cache.clear()
+        if self.prewarm:
+            threading.Thread(target=self.prewarm_map_cache, daemon=True).start()
+
+    def reload_data(self):
+        """
+        Load the data again when files were added to the data folder: only the new
+        trips files are parsed, then the new data is swapped in
+        """
+        from app_figures import Data
+
+        print("Data files changed, loading the new data...")
+        data = Data(self.data_path)
+        # Merge the new files in the cached aggregates before the swap, the years never
+        # opened are read when they are opened
+        data.dataset.prepare(cached_only=True)
+        self.set_data(data)
+
+    def live_layout(self):
+        """
+        Live availability map, updated by a dcc.Interval
+        """
+        if self.live is None:
+            return []
+        return [
+            html.Div(
+                [
+                    html.H3("Live availability"),
+                    dcc.Interval(id="live_interval", interval=LIVE_INTERVAL),
+                    dcc.Graph(
+                        id="live_map",
+                        figure=self.fig_creator.create_availability_map(
+                            self.live.get_availability()
+                        ),
+                    ),
+                    html.H5("Click a station on the map to show its last hour"),
+                    dcc.Graph(id="live_station_history"),
+                ]
+            )
+        ]
+
+    def add_live_callbacks(self):
+        # Only the files completed since the last update are read, the cost does
+        # not depend on the history of the sniffer
+        @self.app.callback(
+            Output("live_map", "figure"),
+            Input("live_interval", "n_intervals"),
+            prevent_initial_call=True,
+        )
+        @timed_callback("update_live_map")
+        def update_live_map(n_intervals):
+            with stage("data"):
+                self.live.poll()
+                stations = self.live.get_availability()
+            with stage("figure"):
+                return self.fig_creator.update_availability_map(stations)
+
+        @self.app.callback(
+            Output("live_station_history", "figure"),
+            Input("live_map", "clickData"),
+            Input("live_interval", "n_intervals"),
+        )
+        @timed_callback("update_live_station_history")
+        def update_live_station_history(clickData, n_intervals):
+            if clickData is None:
+                return go.Figure()
+            station_id = clickData["points"][0]["customdata"]
+            with stage("data"):
+                name = self.live.get_information()["name"].get(station_id, str(station_id))
+                history = self.live.get_station_history(station_id)
+            with stage("figure"):
+                return self.fig_creator.create_station_availability_history(name, history)
+
+    def create_stations_map(self, key):
+        """
+        Returns the patch of the stations map and the number of stations with trajets
+        for the key (begin_period, end_period, best_idxs, viewport bounds, days, hours)
+        """
+        with stage("data"):
+            points, nb_stations = self.data.get_map_points(*key)
+        with stage("figure"):
+            return [self.fig_creator.update_stations_map(points), nb_stations]
+
+    @staticmethod
+    def viewport_bounds(relayoutData):
+        """
+        Returns the bounds (west, south, east, north) of the map from its relayoutData,
+        rounded outward to VIEWPORT_STEP, None if the viewport did not change
+        """
+        if not relayoutData or "mapbox._derived" not in relayoutData:
+            return None
+        longitudes, latitudes = np.array(
+            relayoutData["mapbox._derived"]["coordinates"], dtype=float
+        ).T
+        bounds = [
+            np.floor(longitudes.min() / VIEWPORT_STEP),
+            np.floor(latitudes.min() / VIEWPORT_STEP),
+            np.ceil(longitudes.max() / VIEWPORT_STEP),
+            np.ceil(latitudes.max() / VIEWPORT_STEP),
+        ]
+        return [float(round(bound * VIEWPORT_STEP, 6)) for bound in bounds]
+
+    @staticmethod
+    def time_filter_key(days, hours):
+        """
+        Returns the (days, hours) part of the cache keys, None for all the days/hours
+        """
+        from data_years import DAYS, NB_HOURS
+
+        days = tuple(sorted(days))
+        hours = tuple(hours)
+        return (
+            None if days == tuple(range(len(DAYS))) else days,
+            None if hours == (0, NB_HOURS) else hours,
+        )
+
+    def create_stations_deplacement_history(self, stations_id, days=None, hours=None):
+        with stage("data"):
+            station_names, months, nb_trajets = self.data.get_stations_deplacement(
+                stations_id, days, hours
+            )
+        with stage("figure"):
+            return self.fig_creator.create_stations_deplacement_history(
+                station_names, months, nb_trajets
+            )
+
+    def cache_stats(self) -> dict:
+        """
+        Stats of the figure caches, served with the metrics
+        """
+        return {"caches": [self.map_cache.stats(), self.history_cache.stats()]}
+
+    def prewarm_map_cache(self):
+        """
+        Cache the stations map of the whole last year and of each of its months,
+        with all the stations (default value of the best stations slider)
+        """
+        first = self.data.year_month_to_period(self.data.last_year, 1)
+        best_idxs = len(self.data.bixi_stations)
+        keys = [(first, self.data.max_period_idx, best_idxs, None, None, None)] + [
+            (period, period, best_idxs, None, None, None)
+            for period in range(first, self.data.max_period_idx + 1)
+        ]
+        self.map_cache.prewarm(keys, self.create_stations_map)
+        print(f"Stations map cache prewarmed: {self.map_cache.stats()}")
+
+    def timeline_marks(self, data: "Data"):
+        """
+        Marks of the timeline: every month for one year, else the years and the seasons
+        """
+        from app_figures import MONTHS
+
+        marks = {}
+        for period in range(data.min_period_idx, data.max_period_idx + 1):
+            year, month = data.period_to_year_month(period)
+            if len(data.years) == 1:
+                marks[period] = MONTHS[month - 1]
+            elif month == 1:
+                marks[period] = str(year)
+            elif month in (4, 7, 10):
+                marks[period] = MONTHS[month - 1][:3]
+        return marks
 
 
 if __name__ == "__main__":
-    app = DashApp()
+    # The server starts before the data is loaded
+    app = DashApp(lazy=True)
     app.app.run_server(debug=True)
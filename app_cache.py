@@ -0,0 +1,117 @@
+"""
+Server-side cache of the figures returned by the Dash callbacks
+
+Figures are stored serialized (JSON) in an LRU cache bounded by its size in bytes,
+so sweeping a slider back and forth returns the same figures without building them
+again with Plotly.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from plotly.io.json import to_json_plotly
+
+from app_metrics import stage
+
+
+class FigureCache:
+    """
+    LRU cache of serialized callback outputs (figures, or lists of figures and values)
+    """
+
+    def __init__(self, name: str, max_bytes: int) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.nb_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._figures = OrderedDict()
+        # Dash callbacks can run in several threads
+        self._lock = threading.Lock()
+        # Incremented by clear(), outputs created before are not cached
+        self.generation = 0
+
+    def get_or_create(self, key, create):
+        """
+        Returns the cached output for key (as JSON decoded dicts), create() is called
+        to build it if it is not in the cache
+        """
+        with self._lock:
+            serialized = self._figures.get(key)
+            generation = self.generation
+            if serialized is not None:
+                self._figures.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if serialized is None:
+            output = create()
+        with stage("serialize"):
+            if serialized is None:
+                serialized = to_json_plotly(output)
+                self.put(key, serialized, generation)
+            return json.loads(serialized)
+
+    def put(self, key, serialized: str, generation: int = None):
+        """
+        Add a serialized output to the cache, removing the least recently used
+        ones if the cache is too big. The output is not added if the cache was
+        cleared since generation
+        """
+        size = len(serialized)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._figures:
+                self.nb_bytes -= len(self._figures.pop(key))
+            self._figures[key] = serialized
+            self.nb_bytes += size
+
+            while self.nb_bytes > self.max_bytes:
+                _, evicted = self._figures.popitem(last=False)
+                self.nb_bytes -= len(evicted)
+                self.evictions += 1
+
+    def prewarm(self, keys, create):
+        """
+        Build and cache the outputs of the given keys with create(key)
+        """
+        for key in keys:
+            with self._lock:
+                if key in self._figures:
+                    continue
+                generation = self.generation
+            self.put(key, to_json_plotly(create(key)), generation)
+
+    def clear(self):
+        """
+        Remove all the outputs (e.g. when the data changed)
+        """
+        with self._lock:
+            self._figures.clear()
+            self.nb_bytes = 0
+            self.generation += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counts and the size of the cache
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "name": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "nb_figures": len(self._figures),
+                "nb_bytes": self.nb_bytes,
+                "max_bytes": self.max_bytes,
+            }
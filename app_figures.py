@@ -1,9 +1,10 @@
 import time
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
-import matplotlib as mpl
+from dash import Patch
+from data_spatial import StationGrid
+from data_years import DATA_PATH, DAYS, NB_HOURS, NB_MONTHS, TripsDataset, resident_memory
 
 MONTHS = [
     "January",
@@ -20,15 +21,27 @@ MONTHS = [
     "December",
 ]
 
+# Max size of the markers of the stations map (px.scatter_mapbox default)
+STATIONS_MAP_SIZE_MAX = 20
+
+# Max number of points of the stations map, stations are clustered above
+MAX_MAP_POINTS = 2000
+
+# Number of color/width bins of the deplacement map (one trace per bin)
+NB_FLOW_BINS = 8
 
 class Data:
     """
     Load Data and generate DataFrames
     """
 
-    def __init__(self) -> None:
+    def __init__(self, data_path: str = DATA_PATH) -> None:
         print("Loading data...")
         start_time = time.perf_counter()
+        start_memory = resident_memory()
+
+        # Trips of all the years, the timeline loads the months counts of a year lazily
+        self.dataset = TripsDataset(data_path)
 
         self.get_open_data()
         self.get_deplacements_per_month_per_station()
@@ -41,80 +54,209 @@ class Data:
         # Get station Bixi count
         # self.count_stations = pd.read_csv("data/2021_count_stations.csv")
         
-        # Get all number of deplacements
-        self.deplacements = pd.read_csv("data/2021_deplacements.csv")
+        # Get all number of deplacements between stations of the last year
+        self.od_index = self.dataset.od_index(self.last_year)
         
         end_time = time.perf_counter()
-        print(f"Data loaded! Time needed: {end_time-start_time:.1f} s")
+        print(
+            f"Data loaded! Time needed: {end_time-start_time:.1f} s, "
+            f"resident memory: {start_memory:.0f} -> {resident_memory():.0f} MB"
+        )
 
     def get_open_data(self):
-        # Get deplacements for 2021 (for now) with start_time as index and converted to time object
-        # TODO: get displacement for all years
-        self.data_stations_2021 = pd.read_csv("data/2021_donnees_ouvertes.csv")
-        self.data_stations_2021["start_date"] = pd.to_datetime(
-            self.data_stations_2021["start_date"]
-        )
+        # The timeline has 12 periods (months) per year, from January of the first year
+        self.years = self.dataset.years
+        self.min_period_idx = self.year_month_to_period(self.years[0], 1)
+        self.max_period_idx = self.year_month_to_period(self.years[-1], NB_MONTHS)
+
+        # The history of the stations is shown for the last year
+        self.last_year = self.years[-1]
 
-        # The following is usefull for the timeline
-        self.data_stations_2021.sort_values(by="start_date", inplace=True)
-        self.data_stations_2021["Day"] = self.data_stations_2021[
-            "start_date"
-        ].dt.day_name()
+        # Get Bixi station loc shared by all years (pk is used everywhere in the app)
+        self.bixi_stations = self.dataset.stations
 
-        self.data_stations_2021["Month"] = self.data_stations_2021[
-            "start_date"
-        ].dt.month
+        # Only the stations in the viewport of the map are sent
+        self.stations_grid = StationGrid(
+            self.bixi_stations["latitude"], self.bixi_stations["longitude"]
+        )
 
-        self.min_month_idx = self.data_stations_2021["Month"].min()
-        self.max_month_idx = self.data_stations_2021["Month"].max()
+    def year_month_to_period(self, year: int, month: int) -> int:
+        """
+        Returns the index in the timeline of the month of the year
+        """
+        return (year - self.years[0]) * NB_MONTHS + month
 
-        # Get Bixi station loc (used for merge and to get location of stations)
-        self.bixi_stations = pd.read_csv("data/2021_stations.csv")
+    def period_to_year_month(self, period: int):
+        """
+        Returns the year and the month of the index in the timeline
+        """
+        year, month = divmod(period - 1, NB_MONTHS)
+        return self.years[0] + year, month + 1
 
     def get_deplacements_per_month_per_station(self):
-        # Create dict of deplacement over month for each station
-        # pk=10 : month=[4,5...] nb_trajets=[29238,29323,...]
-        df_pk_group = self.data_stations_2021.groupby("emplacement_pk_start")
-        self.nb_trajets_dict = {}
-        for pk, df in df_pk_group:
-            df = df.groupby("Month").count().filter(items=["start_date"])
-            df = df.rename({"start_date": "nb_trajets"})
-            self.nb_trajets_dict[pk] = df
-
-    def get_deplacements_count(self, filtered_df: pd.DataFrame):
-        """
-        Returns a dataframe with the id and name of the station, the latitude and longitude and the number of trajets
-        """
-        # Get the number of trajets
-        count_stations = filtered_df["emplacement_pk_start"].value_counts()
-        count_stations = pd.DataFrame(
-            {"station_id": count_stations.index, "nb_trajets": count_stations.values}
-        ).set_index("station_id")
-
-        # Join the station_id with the name and the coordinates
-        count_stations = count_stations.merge(
-            self.bixi_stations, left_on="station_id", right_on="pk"
+        # Array of deplacement over month (columns) for each station (rows, by pk)
+        # pk=10 : nb_trajets_per_month[10] = [0, 0, 0, 29238, 29323, ...]
+        counts = self.dataset.month_counts(self.last_year)[1:]
+        self.nb_trajets_per_month = np.ascontiguousarray(counts.T)
+
+        # Months of the last year with deplacements (x axis of the history)
+        self.history_months = np.flatnonzero(counts.sum(axis=1)) + 1
+
+    def time_filter(self, days=None, hours=None):
+        """
+        Returns the day of week x hour mask (flat) of the days (0 is Monday) and the
+        hours [start, end[, None if all the days and hours are selected
+        """
+        days = range(len(DAYS)) if days is None else days
+        start, end = (0, NB_HOURS) if hours is None else hours
+        mask = np.zeros((len(DAYS), NB_HOURS), dtype=np.int32)
+        mask[list(days), start:end] = 1
+        return None if mask.all() else mask.ravel()
+
+    def get_deplacements_count(self, begin_period: int, end_period: int, days=None, hours=None):
+        """
+        Returns the number of trajets per station (same order as bixi_stations)
+        between begin_period and end_period included, on the days of week (0 is Monday)
+        and the start hours [start, end[ (all if None)
+        Only the years in the period are loaded, the filters sum over the small
+        day x hour axes so the cost does not depend on the selected filters
+        """
+        mask = self.time_filter(days, hours)
+        counts = np.zeros(len(self.bixi_stations), dtype=np.int64)
+        begin_year, begin_month = self.period_to_year_month(begin_period)
+        end_year, end_month = self.period_to_year_month(end_period)
+        for year in range(begin_year, end_year + 1):
+            if year not in self.dataset.partitions:
+                continue
+            first = begin_month if year == begin_year else 1
+            last = end_month if year == end_year else NB_MONTHS
+            if mask is None:
+                cube = self.dataset.month_cube(year)
+                counts += cube[last] - cube[first - 1]
+            else:
+                cube = self.dataset.time_cube(year)
+                slab = (cube[last] - cube[first - 1]).reshape(len(mask), -1)
+                counts += mask @ slab
+        return counts
+
+    def get_best_stations(self, begin_period: int, end_period: int, best_idxs: int, days=None, hours=None):
+        """
+        Returns the number of trajets of each station (same order as bixi_stations),
+        a mask of the best_idxs stations and the number of stations with at least
+        one trajet in the period. The stations without location are not on the map,
+        they are not ranked
+        """
+        counts = self.get_deplacements_count(begin_period, end_period, days, hours)
+        ranked = np.where(self.stations_grid.located, counts, 0)
+        nb_active = int(np.count_nonzero(ranked))
+
+        best_idxs = min(best_idxs, nb_active)
+        best = np.zeros(len(counts), dtype=bool)
+        best[np.argpartition(-ranked, best_idxs - 1)[:best_idxs]] = best_idxs > 0
+        return counts, best, nb_active
+
+    def get_map_points(self, begin_period: int, end_period: int, best_idxs: int, bounds=None, days=None, hours=None):
+        """
+        Returns the points of the stations map in bounds (west, south, east, north) and
+        the number of stations with at least one trajet in the period.
+        The best_idxs stations are points (pk, name, latitude, longitude, nb_trajets),
+        if there are more than MAX_MAP_POINTS they are clustered by cells of the grid
+        (pk -1, name "n stations", mean location, sum of nb_trajets)
+        """
+        counts, best, nb_active = self.get_best_stations(
+            begin_period, end_period, best_idxs, days, hours
         )
-        count_stations = count_stations[
-            ["pk", "name", "latitude", "longitude", "nb_trajets"]
-        ]
-        # count_stations.set_index("name",inplace=True)
-        return count_stations
+        idxs = self.stations_grid.query(bounds)
+        idxs = idxs[best[idxs] & (counts[idxs] > 0)]
+
+        points = pd.DataFrame(
+            {
+                "pk": idxs,
+                "name": self.dataset.registry.get_names(idxs),
+                "latitude": self.stations_grid.latitude[idxs],
+                "longitude": self.stations_grid.longitude[idxs],
+                "nb_trajets": counts[idxs],
+            }
+        )
+        if len(points) <= MAX_MAP_POINTS:
+            return points, nb_active
+
+        # Smallest cells with at most MAX_MAP_POINTS clusters
+        level = 0
+        cluster, nb_clusters = self.stations_grid.clusters(idxs, level)
+        while nb_clusters > MAX_MAP_POINTS:
+            level += 1
+            cluster, nb_clusters = self.stations_grid.clusters(idxs, level)
+
+        nb_stations = np.bincount(cluster, minlength=nb_clusters)
+        clusters = pd.DataFrame(
+            {
+                "pk": -1,
+                "name": [f"{nb} stations" for nb in nb_stations],
+                "latitude": np.bincount(cluster, points["latitude"], nb_clusters) / nb_stations,
+                "longitude": np.bincount(cluster, points["longitude"], nb_clusters) / nb_stations,
+                "nb_trajets": np.bincount(cluster, points["nb_trajets"], nb_clusters).astype(np.int64),
+            }
+        )
+        # A cluster of one station is the station
+        single = nb_stations[cluster] == 1
+        for column in points.columns:
+            clusters.loc[cluster[single], column] = points.loc[single, column].to_numpy()
+        return clusters, nb_active
+
+    def get_station_flows(self, pk: int):
+        """
+        Returns a dataframe with the location of the station pk and of the stations
+        where its trajets end with the number of trajets, and the min/max number of trajets
+        """
+        dest, nb = self.od_index.flows(pk)
+        latitude = self.bixi_stations["latitude"].to_numpy()
+        longitude = self.bixi_stations["longitude"].to_numpy()
+        # No line to or from the stations without location
+        located = np.isfinite(latitude[dest]) & np.isfinite(latitude[pk])
+        dest, nb = dest[located], nb[located]
+        flows = pd.DataFrame(
+            {
+                "pickup_latitude": np.full(len(dest), latitude[pk]),
+                "pickup_longitude": np.full(len(dest), longitude[pk]),
+                "dropoff_latitude": latitude[dest],
+                "dropoff_longitude": longitude[dest],
+                "nb": nb,
+            }
+        )
+        return flows, self.od_index.min_max(pk)
 
-    def get_stations_deplacement(self, station_name_list):
+    def get_stations_deplacement(self, station_list_id, days=None, hours=None):
         """
-        get in the deplacement_by_months dict the dataframes that correspond
-        and return it
+        Returns the names of the stations pks, the months of the history and the
+        number of deplacement per month of each station (one row per station)
+        on the days of week and the start hours (all if None)
         """
-        station_list_id = [
-            self.bixi_stations.loc[self.bixi_stations["name"] == name]["pk"].values[0]
-            for name in station_name_list
+        station_list_id = np.unique(np.asarray(station_list_id, dtype=np.int64))
+        # Stations of previous years may have no deplacement in the last year
+        station_list_id = station_list_id[
+            self.nb_trajets_per_month[station_list_id].any(axis=1)
         ]
-        nb_trajets_dict_name = {
-            station_name: self.nb_trajets_dict[station_list_id[idx]]
-            for idx, station_name in enumerate(station_name_list)
-        }
-        return nb_trajets_dict_name
+
+        registry = self.dataset.registry
+        names = registry.get_names(station_list_id)
+        station_names = []
+        for pk, station_name, pks in zip(station_list_id, names, registry.get_pks(names)):
+            # Several stations can have the same name
+            if len(pks) > 1:
+                station_name = f"{station_name} ({pk})"
+            station_names.append(station_name)
+
+        mask = self.time_filter(days, hours)
+        if mask is None:
+            nb_trajets = self.nb_trajets_per_month[station_list_id]
+        else:
+            cube = self.dataset.time_cube(self.last_year)[..., station_list_id]
+            nb_trajets = np.diff(
+                np.tensordot(mask, cube.reshape(len(cube), len(mask), -1), (0, 1)), axis=0
+            ).T
+        nb_trajets = nb_trajets[:, self.history_months - 1]
+        return station_names, self.history_months, nb_trajets
 
 
 class Figures:
@@ -126,6 +268,9 @@ class Figures:
         pass
 
     def create_stations_map(self, stations: pd.DataFrame):
+        # Imported by the first map, the import of plotly.express is slow
+        import plotly.express as px
+
         # If deplacement_sum
         fig = px.scatter_mapbox(
             stations,
@@ -143,41 +288,76 @@ class Figures:
         fig.update_layout(clickmode="event+select")
         return fig
 
-    def create_stations_deplacement_history(self, dfs_dict):
+    def update_stations_map(self, points: pd.DataFrame):
+        """
+        Returns the Patch of a map made by create_stations_map with the points of
+        Data.get_map_points: the arrays of the markers are replaced, so only the
+        points in the viewport are sent to the browser
+        """
+        nb_trajets = points["nb_trajets"].to_numpy()
+        patched_fig = Patch()
+        trace = patched_fig["data"][0]
+        trace["lat"] = points["latitude"].to_numpy()
+        trace["lon"] = points["longitude"].to_numpy()
+        trace["hovertext"] = points["name"].to_numpy()
+        trace["customdata"] = points[["pk"]].to_numpy()
+        marker = trace["marker"]
+        marker["size"] = nb_trajets
+        marker["color"] = nb_trajets
+        # Same size scale as px.scatter_mapbox
+        marker["sizeref"] = 2.0 * max(nb_trajets.max(initial=0), 1) / STATIONS_MAP_SIZE_MAX**2
+        return patched_fig
+
+    def create_stations_deplacement_history(self, station_names, months, nb_trajets):
         fig = go.Figure()
-        for station_name, df in dfs_dict.items():
-            fig.add_trace(go.Scatter(x=df.index, y=df["start_date"], name=station_name))
+        for station_name, y in zip(station_names, nb_trajets):
+            fig.add_trace(go.Scatter(x=months, y=y, name=station_name))
         fig.update_layout(
             margin=dict(l=0, r=0, t=0, b=0),
         )
         return fig
-    
-    def create_stations_deplacement_map(self,deplacements:pd.DataFrame, pickup_name:str):
+
+    def create_stations_deplacement_map(self, flows: pd.DataFrame, min_max_nb):
         # Color bounds for the value gradient
         c1="#22c1c3"
         c2="#fdbb2d"
-        
-        df=deplacements
+
+        df = flows
+        nb = df["nb"].to_numpy()
 
         # Width line bounds according to value
         min_max_width = [1, 4]
-        min_max_nb = [
-            df[df["pickup_name"] == pickup_name]["nb"].min(),
-            df[df["pickup_name"] == pickup_name]["nb"].max(),
-        ]
+
+        # Deplacements are grouped in NB_FLOW_BINS bins of value, one trace per bin
+        if min_max_nb[1] > min_max_nb[0]:
+            mix = np.interp(nb, min_max_nb, [0, 1])
+        else:
+            mix = np.ones(len(nb))
+        bins = np.minimum((mix * NB_FLOW_BINS).astype(int), NB_FLOW_BINS - 1)
+        bins_mix = (np.arange(NB_FLOW_BINS) + 0.5) / NB_FLOW_BINS
+        colors = Figures._color_fader(c1, c2, bins_mix)
+        widths = np.interp(bins_mix, [0, 1], min_max_width)
+
+        # Segments of a bin in one line: pickup, dropoff, NaN (gap) for each deplacement
+        lat = np.column_stack(
+            [df["pickup_latitude"], df["dropoff_latitude"], np.full(len(df), np.nan)]
+        )
+        lon = np.column_stack(
+            [df["pickup_longitude"], df["dropoff_longitude"], np.full(len(df), np.nan)]
+        )
 
         fig = go.Figure()
-        for idx in df[df["pickup_name"] == pickup_name].index:
+        # Biggest flows are drawn last to be on top
+        for b in np.unique(bins):
+            in_bin = bins == b
             fig.add_trace(
                 go.Scattermapbox(
                     mode="lines",
-                    # name="to ...",
-                    lat=[df["pickup_latitude"][idx], df["dropoff_latitude"][idx]],
-                    lon=[df["pickup_longitude"][idx], df["dropoff_longitude"][idx]],
-                    line=dict(
-                        color=Figures._color_fader(c1,c2,np.interp(df["nb"][idx],min_max_nb,[0,1])),
-                        width=np.interp(df["nb"][idx], min_max_nb, min_max_width),
-                    ),
+                    name=f"{nb[in_bin].min()} - {nb[in_bin].max()} trajets",
+                    lat=lat[in_bin].ravel(),
+                    lon=lon[in_bin].ravel(),
+                    line=dict(color=colors[b], width=widths[b]),
+                    hoverinfo="name",
                 )
             )
 
@@ -191,14 +371,93 @@ class Figures:
             showlegend=False,
         )
         return fig
-        
+
+    def create_availability_map(self, stations: pd.DataFrame):
+        """
+        Map of the live availability, stations from LiveAvailability.get_availability
+        """
+        markers = self._availability_markers(stations)
+        fig = go.Figure(
+            go.Scattermapbox(
+                mode="markers",
+                lat=markers["lat"],
+                lon=markers["lon"],
+                customdata=markers["customdata"],
+                hovertext=markers["hovertext"],
+                hoverinfo="text",
+                marker=dict(
+                    color=markers["color"],
+                    cmin=0,
+                    cmax=markers["cmax"],
+                    colorscale="RdYlGn",
+                    showscale=True,
+                ),
+            )
+        )
+        fig.update_layout(
+            mapbox=dict(
+                style="open-street-map",
+                zoom=9.25,
+                center={"lat": 45.5569442, "lon": -73.6336101},
+            ),
+            margin={"r": 0, "t": 0, "l": 0, "b": 0},
+            # Keep the zoom of the user between two updates
+            uirevision="live",
+        )
+        return fig
+
+    def update_availability_map(self, stations: pd.DataFrame):
+        """
+        Returns the Patch of a map made by create_availability_map with the last states:
+        the arrays of the markers are replaced, the stations can change
+        """
+        markers = self._availability_markers(stations)
+        patched_fig = Patch()
+        trace = patched_fig["data"][0]
+        for key in ("lat", "lon", "customdata", "hovertext"):
+            trace[key] = markers[key]
+        trace["marker"]["color"] = markers["color"]
+        trace["marker"]["cmax"] = markers["cmax"]
+        return patched_fig
+
+    @staticmethod
+    def _availability_markers(stations: pd.DataFrame):
+        hovertext = (
+            stations["name"]
+            + "<br>Bikes: " + stations["bikes"].astype(str)
+            + " (ebikes: " + stations["ebikes"].astype(str)
+            + ")<br>Docks: " + stations["docks"].astype(str)
+        )
+        return {
+            "lat": stations["lat"].to_numpy(),
+            "lon": stations["lon"].to_numpy(),
+            "customdata": stations.index.to_numpy(),
+            "hovertext": hovertext.to_numpy(),
+            "color": stations["bikes"].to_numpy(),
+            "cmax": max(int(stations["bikes"].max()) if len(stations) else 0, 1),
+        }
+
+    def create_station_availability_history(self, station_name: str, history: pd.DataFrame):
+        fig = go.Figure()
+        for value in history.columns:
+            fig.add_trace(go.Scatter(x=history.index, y=history[value], name=value, line_shape="hv"))
+        fig.update_layout(
+            title=station_name,
+            margin=dict(l=0, r=0, t=30, b=0),
+        )
+        return fig
+
     @classmethod
-    def _color_fader(cls,c1,c2,mix=0): #fade (linear interpolate) from color c1 (at mix=0) to c2 (mix=1)
-            c1=np.array(mpl.colors.to_rgb(c1))
-            c2=np.array(mpl.colors.to_rgb(c2))
-            return mpl.colors.to_hex((1-mix)*c1 + mix*c2)
+    def _color_fader(cls,c1,c2,mix=0): #fade (linear interpolate) from color c1 (at mix=0) to c2 (mix=1), mix can be an array
+            # "#rrggbb" colors, without importing matplotlib (slow) for to_rgb
+            c1=np.array([int(c1[i:i+2], 16) for i in (1, 3, 5)]) / 255
+            c2=np.array([int(c2[i:i+2], 16) for i in (1, 3, 5)]) / 255
+            mix=np.asarray(mix, dtype=float)[..., np.newaxis]
+            rgb=np.rint(((1-mix)*c1 + mix*c2)*255).astype(int)
+            hex_colors=["#%02x%02x%02x" % tuple(c) for c in rgb.reshape(-1, 3)]
+            return hex_colors if mix.ndim > 1 else hex_colors[0]
 
 
 if __name__ == "__main__":
     data = Data()
-    print(data.data_stations_2021)
+    print(data.bixi_stations)
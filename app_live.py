@@ -0,0 +1,188 @@
+"""
+Live availability of the stations from the sniffer snapshots (BixiSniffer.py)
+
+The .parquet files of the sniffer are numbered and only appear when they are complete,
+so they are tailed in order: a poll only checks if the next file exists and reads it,
+its cost does not depend on the history already on disk. The last states of each
+station are kept in memory in ring buffers.
+"""
+
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from sniffer_parsing import STATION_IDS_FILE, StationIds
+from sniffer_storage import VALUES, snapshot_path
+
+# Sniffer result folder (see BixiSniffer.RESULT_PATH, copied in app.SNIFFER_PATH)
+SNIFFER_PATH = "Sniffer Data"
+
+# Number of states kept per station (1 hour of collects every 20 s)
+RING_SIZE = 180
+
+
+class StationRings:
+    """
+    Last size states (time and VALUES) of each station, indexed by station_id
+    """
+
+    def __init__(self, size: int = RING_SIZE) -> None:
+        self.size = size
+        self.times = np.zeros((0, size), dtype="datetime64[s]")
+        self.values = np.zeros((0, size, len(VALUES)), dtype=np.int16)
+        # Number of states pushed for each station (the next position is head % size)
+        self.head = np.zeros(0, dtype=np.int64)
+
+    def grow(self, nb_stations: int):
+        added = nb_stations - len(self.head)
+        if added > 0:
+            self.times = np.concatenate([self.times, np.zeros((added, self.size), dtype=self.times.dtype)])
+            self.values = np.concatenate([self.values, np.zeros((added, self.size, len(VALUES)), dtype=self.values.dtype)])
+            self.head = np.concatenate([self.head, np.zeros(added, dtype=self.head.dtype)])
+
+    def push(self, station_id: np.ndarray, times: np.ndarray, values: np.ndarray):
+        """
+        Push states sorted by time, a station can have several states
+        """
+        if not len(station_id):
+            return
+        self.grow(int(station_id.max()) + 1)
+
+        # Rank of each state among the states of its station
+        order = np.argsort(station_id, kind="stable")
+        station_id = station_id[order]
+        stations, first, counts = np.unique(station_id, return_index=True, return_counts=True)
+        rank = np.arange(len(station_id)) - np.repeat(first, counts)
+
+        # Only the last size states of a station are written
+        keep = rank >= np.repeat(counts - self.size, counts)
+        station_id, rank, order = station_id[keep], rank[keep], order[keep]
+        position = (self.head[station_id] + rank) % self.size
+        self.times[station_id, position] = times[order]
+        self.values[station_id, position] = values[order]
+        self.head[stations] += counts
+
+    def latest(self):
+        """
+        Returns the station_ids with a state, the time and the VALUES of their last state
+        """
+        station_id = np.flatnonzero(self.head)
+        position = (self.head[station_id] - 1) % self.size
+        return station_id, self.times[station_id, position], self.values[station_id, position]
+
+    def history(self, station_id: int):
+        """
+        Returns the times and the VALUES of the states of a station, oldest first
+        """
+        if station_id >= len(self.head):
+            return self.times[:0, 0], self.values[:0, 0]
+        head = self.head[station_id]
+        positions = np.arange(max(head - self.size, 0), head) % self.size
+        return self.times[station_id, positions], self.values[station_id, positions]
+
+
+class LiveAvailability:
+    """
+    Tail the snapshots of the sniffer into StationRings
+    """
+
+    def __init__(self, result_path: str = SNIFFER_PATH, ring_size: int = RING_SIZE, prefix: str = "Snapshots") -> None:
+        self.result_path = result_path
+        self.snapshots_path = os.path.join(result_path, prefix)
+        self.prefix = prefix
+        self.rings = StationRings(ring_size)
+
+        self.next_file = self.find_last_keyframe_file()
+        self.information = None
+        self._information_mtime = None
+
+        # Polled from the callbacks of several threads
+        self._lock = threading.Lock()
+        self.poll()
+
+    def find_last_keyframe_file(self) -> int:
+        """
+        Returns the number of the last file with a keyframe, the state of all the stations
+        is known from it. Only the footers of the last files are read
+        """
+        nb_files = len(glob.glob(os.path.join(self.snapshots_path, f"{self.prefix}_*.parquet")))
+        for nb_file in range(nb_files, 0, -1):
+            try:
+                metadata = pq.read_metadata(self.file_path(nb_file))
+            except (OSError, ValueError):
+                continue
+            keyframe = metadata.schema.names.index("keyframe")
+            for row_group in range(metadata.num_row_groups):
+                statistics = metadata.row_group(row_group).column(keyframe).statistics
+                if statistics is None or not statistics.has_min_max or statistics.max:
+                    return nb_file
+        return 1
+
+    def poll(self) -> int:
+        """
+        Read the files completed since the last poll, returns the number of new states
+        """
+        with self._lock:
+            nb_states = 0
+            while os.path.exists(self.file_path(self.next_file)):
+                table = pq.read_table(self.file_path(self.next_file), columns=["time", "station_id", *VALUES])
+                self.rings.push(
+                    table["station_id"].to_numpy(),
+                    table["time"].to_numpy().astype("datetime64[s]"),
+                    np.stack([table[value].to_numpy() for value in VALUES], axis=1),
+                )
+                nb_states += table.num_rows
+                self.next_file += 1
+            return nb_states
+
+    def file_path(self, nb_file: int) -> str:
+        return snapshot_path(self.snapshots_path, nb_file, self.prefix)
+
+    def get_information(self) -> pd.DataFrame:
+        """
+        Returns the stations (index station_id, name, lat, lon, capacity) of the last
+        station_information saved by the sniffer, read again only when it changes
+        """
+        path = os.path.join(self.result_path, "station_information.json")
+        ids_path = os.path.join(self.result_path, STATION_IDS_FILE)
+        mtime = tuple(os.stat(file).st_mtime_ns if os.path.exists(file) else None for file in (path, ids_path))
+        if mtime != self._information_mtime:
+            if mtime[0] is None:
+                stations = pd.DataFrame(columns=["station_id", "name", "lat", "lon", "capacity"])
+            else:
+                with open(path) as f:
+                    stations = pd.DataFrame(json.load(f)["data"]["stations"])
+            # Same integer station_ids as the snapshots (see StationIds), the stations
+            # not collected yet have no snapshot
+            if mtime[1] is None:
+                # Sniffer folders saved before the StationIds only have numeric ids
+                stations["station_id"] = StationIds().encode(stations["station_id"])
+            else:
+                stations["station_id"] = StationIds(ids_path).lookup(stations["station_id"])
+            stations = stations[stations["station_id"] >= 0]
+            self.information = stations.set_index("station_id")[["name", "lat", "lon", "capacity"]]
+            self._information_mtime = mtime
+        return self.information
+
+    def get_availability(self) -> pd.DataFrame:
+        """
+        Returns the stations with their last state (time, bikes, ebikes, docks)
+        """
+        stations = self.get_information()
+        with self._lock:
+            station_id, times, values = self.rings.latest()
+        states = pd.DataFrame(values, index=pd.Index(station_id, name="station_id"), columns=VALUES)
+        states["time"] = times
+        return stations.join(states, how="inner")
+
+    def get_station_history(self, station_id: int) -> pd.DataFrame:
+        """
+        Returns the states of a station kept in memory (index time)
+        """
+        with self._lock:
+            times, values = self.rings.history(station_id)
+        return pd.DataFrame(values, index=pd.Index(times, name="time"), columns=VALUES)
@@ -0,0 +1,192 @@
+"""
+Latency histograms of the Dash callbacks
+
+Each callback decorated by timed_callback records its total time and the time of its
+stages: reading the data, building the figure and serializing it (see stage). The time
+of the whole request (with the JSON encoding of the outputs by Dash) is recorded as
+the "response" stage. The histograms are served as JSON by the metrics endpoint.
+
+Disabled by default (no overhead), enabled without code change by the environment:
+
+    BIXI_METRICS=1 python app.py
+    curl http://127.0.0.1:8050/metrics
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Environment variable enabling the metrics
+METRICS_ENV = "BIXI_METRICS"
+
+# URL of the metrics on the Flask server of the app
+METRICS_PATH = "/metrics"
+
+# Upper bounds of the histogram buckets (ms), the last bucket is unbounded
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def metrics_enabled() -> bool:
+    return os.environ.get(METRICS_ENV, "").lower() not in ("", "0", "false", "no")
+
+
+class LatencyHistogram:
+    """
+    Number of measures per bucket of BUCKETS_MS, with their sum and max
+    """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, duration_ms: float):
+        self.counts[bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+        self.count += 1
+        self.sum_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket of the quantile q (max for the last bucket)
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative > 0:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.sum_ms / self.count if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": self.max_ms,
+            "buckets": {
+                f"le_{bound}": count for bound, count in zip(BUCKETS_MS, self.counts)
+            }
+            | {"le_inf": self.counts[-1]},
+        }
+
+
+class CallbackMetrics:
+    """
+    Latency histograms by callback and stage ("total", "data", "figure", "serialize",
+    "response")
+    """
+
+    def __init__(self, enabled: bool = None) -> None:
+        self.enabled = metrics_enabled() if enabled is None else enabled
+        self._histograms = {}
+        # Dash callbacks can run in several threads
+        self._lock = threading.Lock()
+        # Callback running in the current thread, its stages are recorded with it
+        self._local = threading.local()
+
+    def observe(self, callback: str, stage: str, duration_ms: float):
+        with self._lock:
+            histogram = self._histograms.get((callback, stage))
+            if histogram is None:
+                histogram = self._histograms[callback, stage] = LatencyHistogram()
+            histogram.observe(duration_ms)
+
+    def timed_callback(self, name: str):
+        """
+        Decorator recording the total time of the callback name, the stages run by
+        the callback are recorded with its name
+        """
+
+        def decorator(func):
+            if not self.enabled:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                previous = getattr(self._local, "callback", None)
+                self._local.callback = name
+                # Name of the response of the request (see register)
+                self._local.last_callback = name
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, "total", (time.perf_counter() - start) * 1000)
+                    self._local.callback = previous
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Record the time of the block as the stage name of the running callback
+        (nothing outside of a callback, e.g. when the caches are prewarmed)
+        """
+        callback = getattr(self._local, "callback", None) if self.enabled else None
+        if callback is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(callback, name, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the histograms as {callback: {stage: histogram dict}}
+        """
+        with self._lock:
+            snapshot = {}
+            for (callback, stage), histogram in sorted(self._histograms.items()):
+                snapshot.setdefault(callback, {})[stage] = histogram.to_dict()
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def register(self, server, extra=None):
+        """
+        Serve the histograms (and the dict returned by extra(), e.g. the stats of the
+        caches) as JSON at METRICS_PATH of the Flask server, if the metrics are enabled
+        """
+        if not self.enabled:
+            return
+
+        def start_request():
+            self._local.last_callback = None
+            self._local.request_start = time.perf_counter()
+
+        def end_request(response):
+            callback = getattr(self._local, "last_callback", None)
+            if callback is not None:
+                duration = time.perf_counter() - self._local.request_start
+                self.observe(callback, "response", duration * 1000)
+            return response
+
+        server.before_request(start_request)
+        server.after_request(end_request)
+
+        def metrics():
+            response = {"callbacks": self.snapshot()}
+            if extra is not None:
+                response.update(extra())
+            return response
+
+        server.add_url_rule(METRICS_PATH, "metrics", metrics)
+
+
+# Metrics of the callbacks of the app (one per process)
+METRICS = CallbackMetrics()
+timed_callback = METRICS.timed_callback
+stage = METRICS.stage
@@ -0,0 +1,228 @@
+'''
+Benchmark suite of the app on synthetic data at 1x, 10x and 50x the 2021 scale
+
+For each scale, in its own process and folder (<work_dir>/scale_<scale>, data generated
+by synthetic_trips the first time):
+- startup: import of app, cold start (data/cache built from the csv), warm start
+  (data/cache memory-mapped) and first page, first page of the lazy start
+- slider sweeps: stations map of each month and of growing periods, without and with
+  the weekend 17h-20h filters, cold then warm (figure cache)
+- lasso selections: history of the stations in random boxes of the map
+- OD map clicks: deplacement map of random stations
+
+The callbacks are requested through the Flask test client (with the JSON encoding by
+Dash), their latency is printed (ms) with the stages recorded by app_metrics.
+
+python benchmarks/bench_app.py [--scales 1 10 50] [--work-dir bench_data] [--processes 4]
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_PATH))
+sys.path.insert(0, BENCHMARKS_PATH)
+
+from synthetic_trips import write_dataset  # noqa: E402
+
+NB_REQUESTS = 50
+SEED = 0
+
+STATIONS_MAP_OUTPUT = "..stations_map.figure...stations_map_slider_best.max.."
+HISTORY_OUTPUT = "station_deplacement_figure.figure"
+OD_MAP_OUTPUT = "..station_deplacement_map.figure...station_deplacement_h5.children.."
+
+
+def callback_request(client, output: str, inputs: dict) -> float:
+    """
+    Request the callback of output with the inputs {"id.property": value},
+    returns the latency (ms)
+    """
+    body = {
+        "output": output,
+        "outputs": [
+            {"id": name.split(".")[0], "property": name.split(".")[1]}
+            for name in output.strip(".").split("...")
+        ],
+        "inputs": [
+            {"id": name.split(".")[0], "property": name.split(".")[1], "value": value}
+            for name, value in inputs.items()
+        ],
+        "changedPropIds": [next(iter(inputs))],
+        "state": [],
+    }
+    if "..." not in output:
+        body["outputs"] = body["outputs"][0]
+    start = time.perf_counter()
+    response = client.post("/_dash-update-component", json=body)
+    latency = (time.perf_counter() - start) * 1000
+    assert response.status_code in (200, 204), response.data[:200]
+    return latency
+
+
+def report(name: str, latencies: list, metrics=None, callback: str = None):
+    """
+    Print the latency percentiles of a scenario and the mean time of the stages of
+    its callback
+    """
+    latencies = np.asarray(latencies)
+    line = (
+        f"{name:36}: {len(latencies):4} requests, p50 {np.percentile(latencies, 50):8.2f} ms, "
+        f"p90 {np.percentile(latencies, 90):8.2f} ms, max {latencies.max():8.2f} ms"
+    )
+    if metrics is not None:
+        stages = metrics.snapshot().get(callback, {})
+        line += " | " + ", ".join(
+            f"{stage} {stages[stage]['mean_ms']:.2f}"
+            for stage in ("data", "figure", "serialize")
+            if stage in stages
+        )
+        metrics.reset()
+    print(line, flush=True)
+
+
+def slider_sweep(client, data, days: list, hours: list) -> list:
+    best = len(data.bixi_stations)
+    first = data.year_month_to_period(data.last_year, 1)
+    timelines = [[period, period] for period in range(first, data.max_period_idx + 1)]
+    timelines += [[first, period] for period in range(first, data.max_period_idx + 1)]
+    return [
+        callback_request(
+            client,
+            STATIONS_MAP_OUTPUT,
+            {
+                "stations_map_slider_timeline.value": timeline,
+                "stations_map_slider_best.value": best,
+                "stations_map_viewport.data": None,
+                "stations_map_days.value": days,
+                "stations_map_hours.value": hours,
+            },
+        )
+        for timeline in timelines
+    ]
+
+
+def run_scale(scale: float, work_dir: str, processes: int):
+    # Before the import of app_metrics
+    os.environ["BIXI_METRICS"] = "1"
+    scale_dir = os.path.join(work_dir, f"scale_{scale:g}")
+    # The data and its caches (data/cache) are in the scale folder
+    os.makedirs(scale_dir, exist_ok=True)
+    os.chdir(scale_dir)
+    if not os.path.exists(os.path.join("data", "2021_donnees_ouvertes.csv")):
+        print(f"Generating the data of scale {scale:g}...", flush=True)
+        write_dataset("data", scale, seed=SEED)
+    size = sum(os.path.getsize(os.path.join("data", name)) for name in os.listdir("data") if name.endswith(".csv"))
+    print(f"\n=== Scale {scale:g}x 2021: {size / 2**20:.0f} MB of csv ===", flush=True)
+
+    start = time.perf_counter()
+    import app
+    from app_metrics import METRICS
+    from data_years import TripsDataset, resident_memory
+    print(f"{'import app':36}: {(time.perf_counter() - start) * 1000:8.0f} ms", flush=True)
+
+    if os.path.isdir(os.path.join("data", "cache")):
+        for name in os.listdir(os.path.join("data", "cache")):
+            os.remove(os.path.join("data", "cache", name))
+    # Same as data_pipeline.py then the app
+    start = time.perf_counter()
+    if processes:
+        with ProcessPoolExecutor(processes) as pool:
+            TripsDataset("data").prepare(pool)
+    else:
+        TripsDataset("data").prepare()
+    dash_app = app.DashApp(prewarm=False, live_path=None, watch=False)
+    print(f"{'cold start (csv -> data/cache)':36}: {(time.perf_counter() - start) * 1000:8.0f} ms", flush=True)
+
+    start = time.perf_counter()
+    dash_app = app.DashApp(prewarm=False, live_path=None, watch=False)
+    client = dash_app.app.server.test_client()
+    client.get("/")
+    print(
+        f"{'warm start + first page':36}: {(time.perf_counter() - start) * 1000:8.0f} ms, "
+        f"resident memory {resident_memory():.0f} MB",
+        flush=True,
+    )
+    # Server up before the data (python app.py)
+    start = time.perf_counter()
+    lazy_app = app.DashApp(prewarm=False, live_path=None, watch=False, lazy=True)
+    lazy_app.app.server.test_client().get("/_dash-layout")
+    first_page = time.perf_counter() - start
+    lazy_app.data
+    print(
+        f"{'lazy start: first page, data ready':36}: {first_page * 1000:8.0f} ms, "
+        f"{(time.perf_counter() - start) * 1000:8.0f} ms",
+        flush=True,
+    )
+
+    data = dash_app.data
+    METRICS.reset()
+
+    all_days, all_hours = list(range(7)), [0, 24]
+    for name, days, hours in [("", all_days, all_hours), (" weekend 17h-20h", [5, 6], [17, 20])]:
+        for cache in ("cold", "warm"):
+            report(
+                f"slider sweep{name} ({cache})",
+                slider_sweep(client, data, days, hours),
+                METRICS,
+                "update_figure",
+            )
+
+    rng = np.random.default_rng(SEED)
+    counts = data.get_deplacements_count(data.min_period_idx, data.max_period_idx)
+    active = np.flatnonzero(counts)
+
+    latencies = []
+    nb_selected = []
+    while len(latencies) < NB_REQUESTS:
+        pk = rng.choice(active)
+        half = rng.uniform(0.003, 0.03)
+        longitude = data.stations_grid.longitude[pk]
+        latitude = data.stations_grid.latitude[pk]
+        idxs = data.stations_grid.query((longitude - half, latitude - half, longitude + half, latitude + half))
+        # Distinct selections, the history cache is not measured
+        days = [int(day) for day in np.flatnonzero(rng.random(7) < 0.8)] or all_days
+        latencies.append(
+            callback_request(
+                client,
+                HISTORY_OUTPUT,
+                {
+                    "stations_map.selectedData": {"points": [{"customdata": [int(idx)]} for idx in idxs]},
+                    "stations_map_days.value": days,
+                    "stations_map_hours.value": all_hours,
+                },
+            )
+        )
+        nb_selected.append(len(idxs))
+    report(f"lasso ({np.mean(nb_selected):.0f} stations on average)", latencies, METRICS, "update_station_deplacement_by_months")
+
+    latencies = [
+        callback_request(
+            client,
+            OD_MAP_OUTPUT,
+            {"stations_map.clickData": {"points": [{"customdata": [int(pk)], "hovertext": str(pk)}]}},
+        )
+        for pk in rng.choice(active, NB_REQUESTS)
+    ]
+    report("OD map clicks", latencies, METRICS, "update_station_deplacement_map")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the app on synthetic data")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--work-dir", default="bench_data", help="folder of the synthetic data")
+    parser.add_argument("--processes", type=int, default=None, help="process pool of the cold start")
+    args = parser.parse_args()
+
+    for scale in args.scales:
+        process = multiprocessing.Process(
+            target=run_scale, args=(scale, os.path.abspath(args.work_dir), args.processes)
+        )
+        process.start()
+        process.join()
@@ -0,0 +1,96 @@
+'''
+Benchmark of the station_status parsing of the sniffer (CPU time per tick)
+
+Compares the previous DataFrame path (utcfromtimestamp maps, filters, drop_duplicates,
+two pivot_table) with the vectorized numpy path of sniffer_parsing.
+
+python benchmarks/bench_parse_station_status.py [recorded station_status .json ...]
+
+Without files, payloads are generated by sniffer_stand_in (1000 stations).
+A payload can be recorded with:
+curl https://gbfs.velobixi.com/gbfs/fr/station_status.json -o station_status.json
+'''
+
+import datetime as dt
+import json
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sniffer_parsing import availability_matrix, decode_station_status  # noqa: E402
+
+NB_GENERATED_PAYLOADS = 20
+NB_STATIONS = 1000
+NB_REPEATS = 5
+
+
+def legacy_get_data(data: dict):
+    df = pd.DataFrame(data['data']['stations'])
+    df = df[df.is_renting == 1]
+    df = df[df.is_returning == 1]
+    df = df.drop_duplicates(['station_id', 'last_reported'])
+    df.last_reported = df.last_reported.map(
+        lambda x: dt.datetime.utcfromtimestamp(x))
+    df['time'] = data['last_updated']
+    df.time = df.time.map(lambda x: dt.datetime.utcfromtimestamp(x))
+    df = df.set_index('time')
+    df.index = df.index.tz_localize('UTC').tz_convert('America/Montreal')
+    df_bikes = pd.pivot_table(
+        df, columns='station_id', index='time', values='num_bikes_available')
+    df_ebikes = pd.pivot_table(
+        df, columns='station_id', index='time', values='num_ebikes_available')
+    return df_bikes, df_ebikes
+
+
+def vectorized_get_data(data: dict):
+    columns = decode_station_status(data)
+    return availability_matrix(columns, ("bikes", "ebikes"))
+
+
+def load_payloads(paths: list) -> list:
+    if paths:
+        payloads = []
+        for path in paths:
+            with open(path) as f:
+                payloads.append(json.load(f))
+        return payloads
+
+    from sniffer_stand_in import StandInSystem
+    system = StandInSystem("bench", NB_STATIONS, update_every=0, ttl=10)
+    payloads = []
+    for _ in range(NB_GENERATED_PAYLOADS):
+        system.update()
+        payloads.append(json.loads(system.status[0]))
+    return payloads
+
+
+def check(payload: dict):
+    df_bikes, df_ebikes = legacy_get_data(payload)
+    station_ids, (bikes, ebikes) = vectorized_get_data(payload)
+    assert (df_bikes.columns.astype(int).sort_values() == station_ids).all()
+    assert (df_bikes.T.set_axis(df_bikes.columns.astype(int)).sort_index().iloc[:, 0].to_numpy() == bikes).all()
+    assert (df_ebikes.T.set_axis(df_ebikes.columns.astype(int)).sort_index().iloc[:, 0].to_numpy() == ebikes).all()
+
+
+def bench(function, payloads: list) -> float:
+    '''
+    Returns the best mean CPU time per payload (ms)
+    '''
+    timer = timeit.Timer(lambda: [function(payload) for payload in payloads], timer=timeit.time.process_time)
+    return min(timer.repeat(NB_REPEATS, number=1)) / len(payloads) * 1000
+
+
+if __name__ == "__main__":
+    payloads = load_payloads(sys.argv[1:])
+    check(payloads[0])
+    nb_stations = len(payloads[0]["data"]["stations"])
+    print(f"{len(payloads)} payloads, {nb_stations} stations")
+
+    legacy = bench(legacy_get_data, payloads)
+    vectorized = bench(vectorized_get_data, payloads)
+    print(f"DataFrame + pivot_table : {legacy:8.3f} ms/tick")
+    print(f"numpy + scatter         : {vectorized:8.3f} ms/tick ({legacy / vectorized:.1f}x)")
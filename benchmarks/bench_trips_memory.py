@@ -0,0 +1,75 @@
+'''
+Resident memory of the trips of a year: raw csv frame vs TRIPS_SCHEMA pipeline
+
+The raw frame is the previous loading of the app: all the columns of the open data with
+the default int64/float64/object types and the day name as an object column.
+Each pipeline runs in its own process to measure its resident memory.
+
+python benchmarks/bench_trips_memory.py [year]
+'''
+
+import ctypes
+import gc
+import multiprocessing
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_years import find_partitions, read_trips, resident_memory  # noqa: E402
+
+
+def read_raw_trips(csv_paths) -> pd.DataFrame:
+    df = pd.concat(
+        (pd.read_csv(path, parse_dates=["start_date", "end_date"]) for path in csv_paths),
+        ignore_index=True,
+    )
+    df["Day"] = df["start_date"].dt.day_name()
+    df["Month"] = df["start_date"].dt.month
+    return df
+
+
+def release_memory():
+    """
+    Give the freed memory of the parsing back to the OS (glibc), so the resident
+    memory is the memory of the frame kept by the process
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except OSError:
+        pass
+
+
+def measure(read, csv_paths, queue):
+    # First read for the lazy imports and caches of pandas
+    read(csv_paths[:1])
+    release_memory()
+    before = resident_memory()
+    trips = read(csv_paths)
+    release_memory()
+    queue.put((before, resident_memory(), trips.memory_usage(deep=True).sum() / 2**20, len(trips)))
+
+
+def run(read, csv_paths):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(read, csv_paths, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    partitions = find_partitions()
+    year = int(sys.argv[1]) if len(sys.argv) > 1 else max(partitions)
+    csv_paths = partitions[year].trips_paths
+
+    results = {}
+    for name, read in [("raw csv frame", read_raw_trips), ("TRIPS_SCHEMA", read_trips)]:
+        before, after, frame, nb_trips = run(read, csv_paths)
+        results[name] = after - before
+        print(f"{name:14}: {nb_trips} trips, frame {frame:8.1f} MB, resident memory {before:6.0f} -> {after:6.0f} MB (+{after - before:.0f} MB)")
+    print(f"{results['raw csv frame'] / max(results['TRIPS_SCHEMA'], 1):.1f}x less resident memory")
@@ -0,0 +1,119 @@
+'''
+Synthetic Bixi open data at a multiple of the 2021 scale (trips and stations files)
+
+The trips follow the 2021 schema: a season from April to November, commute peaks on
+week days, popular stations downtown. The files are written by chunks, so 50x the 2021
+trips (about 280 million rows, 15 GB of csv) does not need the memory of the trips.
+The same seed gives the same files.
+
+python benchmarks/synthetic_trips.py data_path [scale] [--stations n]
+'''
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Size of the 2021 open data
+TRIPS_2021 = 5_570_000
+STATIONS_2021 = 800
+
+YEAR = 2021
+
+# Rows generated and written at once
+CHUNK_ROWS = 1_000_000
+
+# Relative number of trips by start hour (0h to 23h) on week days and on weekends
+WEEK_HOURS = np.array([2, 1, 1, 1, 1, 2, 5, 12, 16, 9, 7, 8, 9, 9, 9, 10, 14, 18, 13, 9, 7, 5, 4, 3], dtype=float)
+WEEKEND_HOURS = np.array([4, 3, 2, 1, 1, 1, 2, 3, 5, 8, 10, 12, 13, 13, 13, 13, 12, 11, 10, 8, 7, 6, 5, 4], dtype=float)
+
+
+def generate_stations(nb_stations: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Stations around downtown Montreal, the closest to downtown are the most popular
+    (column weight)
+    """
+    latitude = 45.5017 + rng.normal(0, 0.045, nb_stations)
+    longitude = -73.5673 + rng.normal(0, 0.06, nb_stations)
+    distance = np.hypot(latitude - 45.5017, (longitude + 73.5673) * 0.7)
+    return pd.DataFrame(
+        {
+            "pk": np.sort(rng.choice(np.arange(1, nb_stations * 2), nb_stations, replace=False)),
+            "name": [f"Station {idx} / rue {idx % 97}" for idx in range(nb_stations)],
+            "latitude": latitude.round(6),
+            "longitude": longitude.round(6),
+            "weight": np.exp(-distance / 0.03) + 0.05,
+        }
+    )
+
+
+def generate_trips(stations: pd.DataFrame, nb_trips: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Returns nb_trips trips of YEAR between the stations (2021 schema)
+    """
+    days = pd.date_range(f"{YEAR}-04-15", f"{YEAR}-11-15", freq="D")
+    # More trips in summer
+    season = np.sin(np.linspace(0.3, np.pi - 0.3, len(days)))
+    day = rng.choice(len(days), nb_trips, p=season / season.sum())
+    weekend = days.dayofweek.to_numpy()[day] >= 5
+
+    hour = np.where(
+        weekend,
+        rng.choice(24, nb_trips, p=WEEKEND_HOURS / WEEKEND_HOURS.sum()),
+        rng.choice(24, nb_trips, p=WEEK_HOURS / WEEK_HOURS.sum()),
+    )
+    start = (
+        days.to_numpy()[day]
+        + hour * np.timedelta64(3600, "s")
+        + rng.integers(0, 3600, nb_trips) * np.timedelta64(1, "s")
+    )
+    duration = rng.gamma(2.0, 500.0, nb_trips).astype(np.int64) + 60
+
+    weight = stations["weight"].to_numpy()
+    pks = stations["pk"].to_numpy()
+    return pd.DataFrame(
+        {
+            "start_date": start,
+            "emplacement_pk_start": pks[rng.choice(len(pks), nb_trips, p=weight / weight.sum())],
+            "end_date": start + duration * np.timedelta64(1, "s"),
+            "emplacement_pk_end": pks[rng.choice(len(pks), nb_trips, p=weight / weight.sum())],
+            "duration_sec": duration,
+            "is_member": (rng.random(nb_trips) < 0.7).astype(np.int8),
+        }
+    )
+
+
+def write_dataset(data_path: str, scale: float = 1, nb_stations: int = STATIONS_2021, seed: int = 0) -> tuple:
+    """
+    Write the stations and trips files of YEAR in data_path with scale times the
+    trips of 2021, returns the paths of the files
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_path, exist_ok=True)
+    stations_path = os.path.join(data_path, f"{YEAR}_stations.csv")
+    trips_path = os.path.join(data_path, f"{YEAR}_donnees_ouvertes.csv")
+
+    stations = generate_stations(nb_stations, rng)
+    stations.drop(columns="weight").to_csv(stations_path, index=False)
+
+    nb_trips = int(TRIPS_2021 * scale)
+    with open(trips_path, "w", newline="") as f:
+        for start in range(0, nb_trips, CHUNK_ROWS):
+            trips = generate_trips(stations, min(CHUNK_ROWS, nb_trips - start), rng)
+            trips.to_csv(
+                f, index=False, header=start == 0, date_format="%Y-%m-%d %H:%M:%S"
+            )
+    return stations_path, trips_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic Bixi open data")
+    parser.add_argument("data_path")
+    parser.add_argument("scale", type=float, nargs="?", default=1, help="trips as a multiple of 2021")
+    parser.add_argument("--stations", type=int, default=STATIONS_2021)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for path in write_dataset(args.data_path, args.scale, args.stations, args.seed):
+        print(f"{path}: {os.path.getsize(path) / 2**20:.0f} MB")
@@ -0,0 +1,217 @@
+"""
+Cache of the aggregates of the Bixi csv files
+
+The first load counts the trips of the csv files and writes the aggregates (NumPy
+arrays) as .npy files in the cache folder of the data folder (see cache_dir). The
+following loads memory-map them read-only, so several processes serving the app share
+their pages.
+Each version of an array is a new .npy file named in the metadata of the cache, and
+only one process at a time builds or updates a cache (file lock).
+A cache is rebuilt when one of its source files changes (size/mtime, then content hash).
+An array cache can also be updated when source files are only added (e.g. a new month
+of trips): only the new files are parsed and merged into the cached array.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock, the caches are still replaced atomically
+    fcntl = None
+
+# Folder of the caches in the data folder
+CACHE_FOLDER = "cache"
+
+# Bump when the cleaning functions change so old caches are rebuilt
+CACHE_VERSION = 5
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the blake2b hash of the content of the file
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _tmp_path(path: str) -> str:
+    # Unique per process and thread: several workers can build the same cache
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _source_stat(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cache_dir(data_path: str) -> str:
+    """
+    Returns the folder of the caches of the files of data_path (whatever the working
+    directory of the process)
+    """
+    return os.path.join(data_path, CACHE_FOLDER)
+
+
+def _as_list(source_paths):
+    return [source_paths] if isinstance(source_paths, str) else list(source_paths)
+
+
+def cached_sources(source_paths, name: str, cache_dir: str):
+    """
+    Returns the source files the cache was built from if they did not change,
+    None if the cache is missing, outdated or built from other files than source_paths
+    """
+    meta = _read_valid_meta(source_paths, name, cache_dir)
+    return None if meta is None else _meta_paths(meta)
+
+
+def has_cache(name: str, cache_dir: str) -> bool:
+    """
+    Returns True if the cache name was built, even from other or changed source files
+    """
+    return os.path.exists(os.path.join(cache_dir, f"{name}.json"))
+
+
+def _read_valid_meta(source_paths, name: str, cache_dir: str):
+    """
+    Returns the metadata of the cache if its source files are a part of source_paths
+    and did not change, else None
+    """
+    source_paths = _as_list(source_paths)
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    paths = [source["path"] for source in meta["sources"]]
+    if not set(paths) <= set(source_paths):
+        return None
+
+    touched = False
+    for source in meta["sources"]:
+        stat = _source_stat(source["path"])
+        if stat["size"] != source["size"]:
+            return None
+        if stat["mtime_ns"] != source["mtime_ns"]:
+            if file_hash(source["path"]) != source["hash"]:
+                return None
+            source.update(stat)
+            touched = True
+
+    if touched:
+        _write_meta(meta, meta_path)
+    return meta
+
+
+def _write_meta(meta: dict, meta_path: str):
+    tmp_path = _tmp_path(meta_path)
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _save_signature(source_paths, name, cache_dir: str, extra=None):
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+    # The hash of the files that did not change is not computed again
+    known = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            known = {source["path"]: source for source in json.load(f).get("sources", [])}
+
+    sources = []
+    for path in source_paths:
+        source = _source_stat(path)
+        previous = known.get(path)
+        if previous is not None and all(previous[key] == source[key] for key in ("size", "mtime_ns")):
+            source["hash"] = previous["hash"]
+        else:
+            source["hash"] = file_hash(path)
+        sources.append(source)
+    _write_meta({"version": CACHE_VERSION, "sources": sources, **(extra or {})}, meta_path)
+
+
+@contextmanager
+def _cache_lock(name: str, cache_dir: str):
+    """
+    Lock of the cache name between processes (e.g. the workers of a WSGI server), so
+    only one process builds or updates it
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(cache_dir, f"{name}.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_cached_array(source_paths, name: str, build, cache_dir: str, update=None):
+    """
+    Returns the NumPy array computed by build() from the source files, memory-mapped
+    from <cache_dir>/<name>.<id>.npy when it is up to date
+    If the cache was built from a part of the source files that did not change,
+    update(array, new_paths) returns the cached array merged with the data of the
+    new files instead of building it again from all the files
+    Each version of the array is a new file named in the metadata with its source
+    files, so the array and its sources are replaced together (a process never merges
+    new files into an array that already has them)
+    """
+    source_paths = _as_list(source_paths)
+    meta = _read_valid_meta(source_paths, name, cache_dir)
+    if meta is not None and _meta_paths(meta) == source_paths:
+        return _load_array(meta, cache_dir)
+
+    with _cache_lock(name, cache_dir):
+        # Another process may have built or updated the cache meanwhile
+        meta = _read_valid_meta(source_paths, name, cache_dir)
+        paths = None if meta is None else _meta_paths(meta)
+        if paths == source_paths:
+            return _load_array(meta, cache_dir)
+
+        if paths is not None and update is not None:
+            new_paths = [path for path in source_paths if path not in paths]
+            print(f"Updating cache {name} with {new_paths}...")
+            array = update(_load_array(meta, cache_dir), new_paths)
+        else:
+            array = build()
+
+        array_file = f"{name}.{uuid.uuid4().hex[:12]}.npy"
+        cache_path = os.path.join(cache_dir, array_file)
+        tmp_path = _tmp_path(cache_path)
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, cache_path)
+        _save_signature(source_paths, name, cache_dir, {"array": array_file})
+
+        # The previous file is kept for the processes that just read the previous
+        # metadata, the processes that memory-mapped older files keep reading them
+        keep = {array_file, meta and meta.get("array")}
+        for old_file in os.listdir(cache_dir):
+            if old_file.startswith(f"{name}.") and old_file.endswith(".npy") and old_file not in keep:
+                os.remove(os.path.join(cache_dir, old_file))
+    # Return the memory-mapped file so processes share the same pages
+    return np.load(cache_path, mmap_mode="r")
+
+
+def _meta_paths(meta: dict) -> list:
+    return [source["path"] for source in meta["sources"]]
+
+
+def _load_array(meta: dict, cache_dir: str) -> np.ndarray:
+    return np.load(os.path.join(cache_dir, meta["array"]), mmap_mode="r")
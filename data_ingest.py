@@ -0,0 +1,87 @@
+"""
+Incremental ingestion of the trips files added to the data folder
+
+DataWatcher polls the csv files of the data folder and calls on_change when files were
+added or changed (and did not change since the previous poll, so a file being copied
+is not read). Reloading the data only parses the new files: the cached aggregates of
+the years are updated with their counts (see data_cache.load_cached_array) and the
+arrays of the shared station dimension are built from these aggregates.
+"""
+
+import glob
+import os
+import threading
+
+from data_years import DATA_PATH
+
+# Time between two checks of the data folder (s)
+WATCH_INTERVAL = 60
+
+
+def data_signature(data_path: str = DATA_PATH) -> tuple:
+    """
+    Returns the name, size and mtime of the csv files of the data folder
+    """
+    signature = []
+    for path in sorted(glob.glob(os.path.join(data_path, "*.csv"))):
+        try:
+            stat = os.stat(path)
+        except OSError:  # removed since glob
+            continue
+        signature.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+class DataWatcher:
+    """
+    Call on_change() in a thread when the csv files of data_path change
+    """
+
+    def __init__(self, data_path: str, on_change, interval: float = WATCH_INTERVAL) -> None:
+        self.data_path = data_path
+        self.on_change = on_change
+        self.interval = interval
+
+        # Signature of the loaded data and of the previous poll
+        self.signature = data_signature(data_path)
+        self._pending = self.signature
+
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def check(self) -> bool:
+        """
+        Returns True if the files changed and are the same as at the previous check
+        """
+        signature = data_signature(self.data_path)
+        stable = signature == self._pending
+        self._pending = signature
+        if stable and signature != self.signature:
+            self.signature = signature
+            return True
+        return False
+
+    def start(self):
+        """
+        Start the watcher thread of this process (once per process: the threads of
+        the master process are not forked in the workers of a WSGI server)
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            if not self.check():
+                continue
+            try:
+                self.on_change()
+            except Exception as e:  # keep the app on the previous data
+                print(f"Error while loading the new data files: {e!r}")
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,81 @@
+"""
+Origin-destination index of the deplacements
+
+The number of trajets between stations is stored in a CSR layout keyed by the pickup
+station pk: the destinations of origin pk are dest[indptr[pk]:indptr[pk + 1]] and the
+number of trajets nb[indptr[pk]:indptr[pk + 1]], so the flows of one station are read
+in O(degree) without scanning all the pairs.
+"""
+
+import numpy as np
+
+
+class ODIndex:
+    """
+    Number of trajets per (pickup station, dropoff station) pair in CSR layout
+    """
+
+    def __init__(self, indptr: np.ndarray, dest: np.ndarray, nb: np.ndarray) -> None:
+        self.indptr = indptr
+        self.dest = dest
+        self.nb = nb
+
+        # Min/max number of trajets from each station (0 if no trajet)
+        nb_stations = len(indptr) - 1
+        has_flows = np.diff(indptr) > 0
+        self.min_nb = np.zeros(nb_stations, dtype=nb.dtype)
+        self.max_nb = np.zeros(nb_stations, dtype=nb.dtype)
+        if has_flows.any():
+            starts = indptr[:-1][has_flows]
+            self.min_nb[has_flows] = np.minimum.reduceat(nb, starts)
+            self.max_nb[has_flows] = np.maximum.reduceat(nb, starts)
+
+    @classmethod
+    def from_pairs(cls, origin, dest, nb, nb_stations: int):
+        """
+        Build the index from (origin, dest, nb) pairs, pairs can be repeated
+        (they are summed) and trajets to the same station are dropped
+        """
+        origin = np.asarray(origin, dtype=np.int64)
+        dest = np.asarray(dest, dtype=np.int64)
+        known = (origin >= 0) & (dest >= 0) & (origin != dest)
+
+        keys, inverse = np.unique(
+            origin[known] * nb_stations + dest[known], return_inverse=True
+        )
+        nb = np.bincount(inverse, weights=np.asarray(nb)[known]).astype(np.int32)
+        origin, dest = np.divmod(keys, nb_stations)
+
+        indptr = np.zeros(nb_stations + 1, dtype=np.int32)
+        np.cumsum(np.bincount(origin, minlength=nb_stations), out=indptr[1:])
+        return cls(indptr, dest.astype(np.min_scalar_type(nb_stations)), nb)
+
+    def to_array(self) -> np.ndarray:
+        """
+        Returns indptr, dest and nb packed in one int32 array (to be cached in one file)
+        """
+        return np.concatenate([self.indptr, self.dest, self.nb]).astype(np.int32)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, nb_stations: int):
+        """
+        Returns the index packed by to_array, the arrays are views of array
+        (it can be memory-mapped)
+        """
+        indptr = array[: nb_stations + 1]
+        nb_pairs = (len(array) - len(indptr)) // 2
+        dest = array[len(indptr) : len(indptr) + nb_pairs]
+        return cls(indptr, dest, array[len(indptr) + nb_pairs :])
+
+    def flows(self, pk: int):
+        """
+        Returns the destination pks and the number of trajets from the station pk
+        """
+        start, end = self.indptr[pk], self.indptr[pk + 1]
+        return self.dest[start:end], self.nb[start:end]
+
+    def min_max(self, pk: int):
+        """
+        Returns the min and max number of trajets from the station pk to one station
+        """
+        return self.min_nb[pk], self.max_nb[pk]
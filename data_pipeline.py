@@ -0,0 +1,143 @@
+"""
+Out-of-core aggregation of the trips csv files
+
+The trips files are read by chunks of chunksize rows and only the counts of each chunk
+are kept, so the memory does not depend on the size of the files. The files are split
+in byte ranges (aligned on lines) of range_size bytes: the ranges of big files can be
+counted in a process pool and their counts merged.
+
+The counts are saved in data/cache (.npy) by the YearPartition of data_years, where the
+app memory-maps them. To prepare all the years:
+
+    python data_pipeline.py --processes 4
+"""
+
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import pandas as pd
+
+# Number of rows parsed at once
+CHUNK_SIZE = 500_000
+
+# Size of the parts of a csv file counted by one task (bytes)
+RANGE_SIZE = 64 * 2**20
+
+
+class _RangeFile(io.RawIOBase):
+    """
+    Binary file limited to the bytes [start, end[ of path
+    """
+
+    def __init__(self, path: str, start: int, end: int) -> None:
+        self._file = open(path, "rb")
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        size = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= size
+        return size
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def split_csv(path: str, range_size: int = RANGE_SIZE) -> list:
+    """
+    Returns the (start, end) byte ranges of the rows of the csv file (without its
+    header), each range starts at the beginning of a line
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.readline()
+        bounds = [f.tell()]
+        while bounds[-1] + range_size < size:
+            f.seek(bounds[-1] + range_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def read_csv_range(path: str, start: int, end: int, chunksize: int = CHUNK_SIZE, usecols=None):
+    """
+    Yields the rows of the byte range of the csv file by DataFrames of chunksize rows
+    """
+    columns = pd.read_csv(path, nrows=0).columns
+    if usecols is not None:
+        usecols = [column for column in columns if column in usecols]
+    with io.TextIOWrapper(io.BufferedReader(_RangeFile(path, start, end)), encoding="utf-8") as f:
+        yield from pd.read_csv(
+            f, header=None, names=columns, usecols=usecols, chunksize=chunksize
+        )
+
+
+def count_range(count, merge, path: str, start: int, end: int, chunksize: int, usecols):
+    """
+    Returns the counts of the rows of the byte range, count(chunk) is merged chunk by chunk
+    """
+    counts = None
+    for chunk in read_csv_range(path, start, end, chunksize, usecols):
+        chunk_counts = count(chunk)
+        counts = chunk_counts if counts is None else merge(counts, chunk_counts)
+    return counts
+
+
+def aggregate_files(paths, count, merge, usecols=None, pool=None, chunksize: int = CHUNK_SIZE, range_size: int = RANGE_SIZE):
+    """
+    Returns the merged counts of all the rows of the csv files: count(chunk) returns the
+    counts of a DataFrame of rows, merge(counts, counts) merges two counts.
+    The byte ranges of the files are counted in pool (a concurrent.futures executor)
+    if given, count and merge must then be picklable (module functions or partials).
+    Returns None if the files have no rows
+    """
+    tasks = [
+        (path, start, end) for path in paths for start, end in split_csv(path, range_size)
+    ]
+    if pool is None:
+        results = [count_range(count, merge, *task, chunksize, usecols) for task in tasks]
+    else:
+        futures = [
+            pool.submit(count_range, count, merge, *task, chunksize, usecols)
+            for task in tasks
+        ]
+        results = [future.result() for future in futures]
+    results = [counts for counts in results if counts is not None]
+    return reduce(merge, results) if results else None
+
+
+if __name__ == "__main__":
+    from data_years import DATA_PATH, TripsDataset, resident_memory
+
+    parser = argparse.ArgumentParser(description="Aggregate the Bixi trips files by chunks")
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--processes", type=int, default=None, help="size of the process pool (no pool by default)")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--range-size", type=int, default=RANGE_SIZE, help="bytes of csv per task")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    dataset = TripsDataset(args.data_path)
+    if args.processes:
+        with ProcessPoolExecutor(args.processes) as pool:
+            dataset.prepare(pool, args.chunksize, args.range_size)
+    else:
+        dataset.prepare(None, args.chunksize, args.range_size)
+    print(
+        f"Data prepared! Time needed: {time.perf_counter() - start_time:.1f} s, "
+        f"resident memory: {resident_memory():.0f} MB"
+    )
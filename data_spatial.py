@@ -0,0 +1,94 @@
+"""
+Spatial index of the stations for the viewport of the maps
+
+The stations are sorted by the cell (iy, ix) of a regular latitude/longitude grid.
+Only the cells with stations are stored, the stations without location (NaN, or at
+-1, -1 in the open data) are not in the grid. The stations of the row iy between the
+cells ix0 and ix1 are found with a binary search of the sorted cells, so the stations
+in a viewport are found without scanning all the stations.
+The cells of level l group 2**l x 2**l cells, they are used to cluster the stations.
+"""
+
+import numpy as np
+
+# Size of the cells of the grid (degrees, about 500 m in latitude)
+CELL_SIZE = 0.005
+
+# Cell (iy, ix) key: iy << CELL_BITS | ix
+CELL_BITS = 32
+
+# Coordinates of the stations without location in the open data
+UNLOCATED = -1.0
+
+
+class StationGrid:
+    """
+    Regular grid index of stations locations
+    """
+
+    def __init__(self, latitude, longitude, cell_size: float = CELL_SIZE) -> None:
+        self.latitude = np.asarray(latitude, dtype=float)
+        self.longitude = np.asarray(longitude, dtype=float)
+        self.cell_size = cell_size
+
+        # Stations with a location, the others are not in the grid
+        self.located = located = (
+            np.isfinite(self.latitude)
+            & np.isfinite(self.longitude)
+            & ~((self.latitude == UNLOCATED) & (self.longitude == UNLOCATED))
+        )
+        self.south = self.latitude[located].min() if located.any() else 0.0
+        self.west = self.longitude[located].min() if located.any() else 0.0
+
+        # Cell of each station (-1 if the station has no location)
+        self.iy = np.full(len(self.latitude), -1, dtype=np.int64)
+        self.ix = np.full(len(self.latitude), -1, dtype=np.int64)
+        self.iy[located] = self.cell(self.latitude[located], self.south)
+        self.ix[located] = self.cell(self.longitude[located], self.west)
+
+        keys = self.iy[located] << CELL_BITS | self.ix[located]
+        sort = np.argsort(keys, kind="stable")
+        self.order = np.flatnonzero(located)[sort]
+        self.keys = keys[sort]
+        self.rows = np.unique(self.iy[located])
+
+    def cell(self, values, origin: float):
+        return np.floor((np.asarray(values) - origin) / self.cell_size).astype(np.int64)
+
+    def query(self, bounds=None) -> np.ndarray:
+        """
+        Returns the indexes (sorted) of the stations in bounds (west, south, east, north),
+        all the located stations if bounds is None
+        """
+        if bounds is None:
+            return np.sort(self.order)
+        west, south, east, north = bounds
+        iy0, iy1 = self.cell([south, north], self.south)
+        ix0, ix1 = np.clip(self.cell([west, east], self.west), 0, (1 << CELL_BITS) - 1)
+
+        rows = self.rows[(self.rows >= iy0) & (self.rows <= iy1)]
+        starts = np.searchsorted(self.keys, rows << CELL_BITS | ix0, side="left")
+        ends = np.searchsorted(self.keys, rows << CELL_BITS | ix1, side="right")
+        candidates = self.order[
+            np.concatenate(
+                [np.arange(start, end) for start, end in zip(starts, ends)]
+                or [np.zeros(0, dtype=np.int64)]
+            )
+        ]
+        # The cells of the border are partially in bounds
+        inside = (
+            (self.latitude[candidates] >= south)
+            & (self.latitude[candidates] <= north)
+            & (self.longitude[candidates] >= west)
+            & (self.longitude[candidates] <= east)
+        )
+        return np.sort(candidates[inside])
+
+    def clusters(self, idxs: np.ndarray, level: int):
+        """
+        Group the stations idxs by cell of level (2**level x 2**level cells).
+        Returns the cluster of each station and the number of clusters
+        """
+        keys = (self.iy[idxs] >> level) << CELL_BITS | (self.ix[idxs] >> level)
+        _, inverse = np.unique(keys, return_inverse=True)
+        return inverse, int(inverse.max()) + 1 if len(inverse) else 0
@@ -0,0 +1,108 @@
+"""
+Registry of the Bixi stations shared by all years
+
+A station keeps the same pk across years when it has the same name, or the same
+location if it was renamed. Two stations of the same year with the same name but
+different locations stay two stations.
+The pk of a station is its row in registry.stations, so pk -> station is an array
+lookup, and names (current and previous ones) are indexed in a dict.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Stations closer than 10^-LOCATION_DECIMALS degree (about 10 m) are the same location
+LOCATION_DECIMALS = 4
+
+
+class StationRegistry:
+    """
+    Station dimension with indexes by pk, name and (year, row of the year stations)
+    """
+
+    def __init__(self, partitions: dict) -> None:
+        """
+        partitions: YearPartition of each year, each partition gets the array
+        idx_to_global (row of partition.stations -> pk)
+        """
+        names = []
+        latitudes = []
+        longitudes = []
+        self.name_index = {}
+        location_index = {}
+
+        # Most recent year first: the registry keeps the last name and location
+        for year in sorted(partitions, reverse=True):
+            partition = partitions[year]
+            stations = partition.stations
+            idx_to_global = np.empty(len(stations), dtype=np.int64)
+            pks_of_year = set()
+
+            locations = zip(
+                stations["latitude"].round(LOCATION_DECIMALS),
+                stations["longitude"].round(LOCATION_DECIMALS),
+            )
+            for idx, (name, location) in enumerate(zip(stations["name"], locations)):
+                pk = self._match(name, location, location_index, pks_of_year)
+                if pk is None:
+                    pk = len(names)
+                    names.append(name)
+                    latitudes.append(stations["latitude"].iat[idx])
+                    longitudes.append(stations["longitude"].iat[idx])
+                elif np.isnan(latitudes[pk]):
+                    # Location of a previous year if the last one has none
+                    latitudes[pk] = stations["latitude"].iat[idx]
+                    longitudes[pk] = stations["longitude"].iat[idx]
+
+                idx_to_global[idx] = pk
+                pks_of_year.add(pk)
+                if pk not in self.name_index.setdefault(name, []):
+                    self.name_index[name].append(pk)
+                location_index.setdefault(location, pk)
+
+            partition.idx_to_global = idx_to_global
+
+        self.stations = pd.DataFrame(
+            {
+                "pk": np.arange(len(names)),
+                "name": names,
+                "latitude": latitudes,
+                "longitude": longitudes,
+            }
+        )
+        self.names = self.stations["name"].to_numpy()
+
+    def _match(self, name, location, location_index, pks_of_year):
+        """
+        Returns the pk of an already registered station with the same name (same
+        location if the name is used by several stations), else with the same location
+        """
+        candidates = self.name_index.get(name, [])
+        for pk in candidates:
+            if location_index.get(location) == pk:
+                return pk
+        for pk in candidates:
+            # A name used twice in the same year with two locations is two stations
+            if pk not in pks_of_year:
+                return pk
+
+        pk = location_index.get(location)
+        if pk is not None and pk not in pks_of_year:
+            return pk
+        return None
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    def get_names(self, pks) -> np.ndarray:
+        """
+        Returns the (most recent) name of each station pk
+        """
+        return self.names[np.asarray(pks, dtype=np.int64)]
+
+    def get_pks(self, names) -> list:
+        """
+        Returns the pks of the stations with each name (a name can be used by
+        several stations or have been renamed since), [] for an unknown name
+        """
+        return [self.name_index.get(name, []) for name in names]
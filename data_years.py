@@ -0,0 +1,523 @@
+"""
+Year-partitioned Bixi trips dataset
+
+Each year is a partition with its own trips and stations files in the data folder:
+    - 2021 and later: <year>_donnees_ouvertes.csv and <year>_stations.csv
+    - 2014 to 2020: OD_<year>*.csv and Stations_<year>.csv (see transfo-data/conv18-19-20.ipynb)
+
+Partitions are loaded lazily: the timeline only needs the month x station counts of a
+year, which are cached in data/cache so the trips of a year are parsed once.
+The stations of all years share one dimension (see data_stations) whose "pk" is the row
+index; the arrays returned by the dataset use this pk.
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import data_cache
+import data_pipeline
+from data_od import ODIndex
+from data_pipeline import CHUNK_SIZE, RANGE_SIZE
+from data_spatial import UNLOCATED
+from data_stations import StationRegistry
+
+# Default data folder (copied in app.DATA_PATH)
+DATA_PATH = "data"
+
+DAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+# Number of months in a year (the timeline uses 12 periods per year)
+NB_MONTHS = 12
+
+# Number of hours in a day (the trips are counted by hour of their start)
+NB_HOURS = 24
+
+# Columns of the 2014-2020 open data renamed to the 2021 schema
+TRIPS_COLUMNS = {
+    "start_station_code": "emplacement_pk_start",
+    "end_station_code": "emplacement_pk_end",
+}
+STATIONS_COLUMNS = {"code": "pk"}
+
+# Location of the stations at -1, -1 in the open data, found by hand (name without
+# spaces, lowercase). Peel / Smith was corrected in DataCleaning-deplacement.ipynb
+KNOWN_LOCATIONS = {"peel/smith": (45.49277, -73.55641)}
+
+# Columns kept from the trips (the app only counts the trips per station, month and
+# day) and their smallest type, the other columns of the open data are not read
+TRIPS_SCHEMA = {
+    "emplacement_pk_start": np.int16,
+    "emplacement_pk_end": np.int16,
+    "Month": np.uint8,
+    "Day": "category",
+    "Hour": np.uint8,
+}
+
+# Columns read from the trips files (2021 and 2014-2020 schemas)
+TRIPS_USECOLS = {"start_date", *TRIPS_COLUMNS, *TRIPS_COLUMNS.values()}
+
+# Aggregates of the trips of a year, counted in one pass over the trips files
+AGGREGATES = ["month_counts", "time_counts", "od_pairs"]
+
+
+def read_trips(csv_paths) -> pd.DataFrame:
+    """
+    Parse and clean the trips csv files of a year (see clean_trips), sorted by start
+    date. The app only uses the aggregates of the trips (see YearPartition), the whole
+    trips are read by benchmarks/bench_trips_memory.py
+    """
+    df = pd.concat(
+        (
+            pd.read_csv(path, usecols=lambda column: column in TRIPS_USECOLS)
+            for path in csv_paths
+        ),
+        ignore_index=True,
+    )
+    return clean_trips(df, sort=True)
+
+
+def clean_trips(df: pd.DataFrame, sort: bool = False) -> pd.DataFrame:
+    """
+    Returns the TRIPS_SCHEMA columns of the raw trips: columns renamed to the 2021
+    schema, station pks downcast to int16 (int32 if they do not fit, -1 if unknown),
+    month and hour of the start as uint8 and day of week as a categorical (int8 codes)
+    """
+    df = df.rename(columns=TRIPS_COLUMNS)
+    start_date = pd.to_datetime(df["start_date"])
+    order = np.argsort(start_date.to_numpy(), kind="stable") if sort else slice(None)
+    start_date = start_date.iloc[order].dt
+
+    trips = pd.DataFrame(
+        {
+            column: downcast_pks(df[column].to_numpy()[order])
+            for column in ["emplacement_pk_start", "emplacement_pk_end"]
+        }
+    )
+    trips["Month"] = start_date.month.to_numpy(dtype=TRIPS_SCHEMA["Month"])
+    trips["Day"] = pd.Categorical.from_codes(
+        start_date.dayofweek.to_numpy(dtype=np.int8), categories=DAYS, ordered=True
+    )
+    trips["Hour"] = start_date.hour.to_numpy(dtype=TRIPS_SCHEMA["Hour"])
+    return trips
+
+
+def downcast_pks(pks) -> np.ndarray:
+    """
+    Returns the station pks as int16 (int32 if they do not fit), -1 if not a number
+    """
+    pks = pd.to_numeric(pd.Series(pks), errors="coerce").fillna(-1).to_numpy(np.int64)
+    dtype = TRIPS_SCHEMA["emplacement_pk_start"]
+    if pks.size and pks.max() > np.iinfo(dtype).max:
+        dtype = np.int32
+    return pks.astype(dtype)
+
+
+def resident_memory() -> float:
+    """
+    Returns the resident memory of the process (MB)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        # Peak resident memory if /proc is not available (kB on Linux, bytes on macOS)
+        import resource
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def read_stations(csv_path: str) -> pd.DataFrame:
+    """
+    Returns the stations of a year with the columns pk, name, latitude and longitude.
+    The stations without location in the open data (at -1, -1, e.g. Peel / Smith in
+    2021) get their KNOWN_LOCATIONS, else NaN coordinates: they are not drawn on the
+    maps
+    """
+    df = pd.read_csv(csv_path).rename(columns=STATIONS_COLUMNS)
+    df = df[["pk", "name", "latitude", "longitude"]]
+    unlocated = (df["latitude"] == UNLOCATED) & (df["longitude"] == UNLOCATED)
+    df.loc[unlocated, ["latitude", "longitude"]] = np.nan
+    for idx in np.flatnonzero(unlocated):
+        key = df["name"].iat[idx].replace(" ", "").lower()
+        if key in KNOWN_LOCATIONS:
+            df.loc[df.index[idx], ["latitude", "longitude"]] = KNOWN_LOCATIONS[key]
+    return df
+
+
+def lookup(table: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    Returns table[keys] with -1 for the keys outside of the table
+    """
+    keys = np.asarray(keys)
+    values = np.full(len(keys), -1, dtype=table.dtype)
+    known = (keys >= 0) & (keys < len(table))
+    values[known] = table[keys[known]]
+    return values
+
+
+class YearPartition:
+    """
+    Trips and stations files of one year, loaded on demand
+    """
+
+    def __init__(self, year: int, trips_paths: list, stations_path: str, cache_dir: str) -> None:
+        self.year = year
+        self.trips_paths = trips_paths
+        self.stations_path = stations_path
+        self.cache_dir = cache_dir
+        self.stations = read_stations(stations_path)
+
+        # Local pk -> row of self.stations
+        pks = self.stations["pk"].to_numpy()
+        self.pk_to_idx = np.full(pks.max() + 1, -1, dtype=np.int32)
+        self.pk_to_idx[pks] = np.arange(len(pks), dtype=np.int32)
+
+        # AGGREGATES of the trips files being counted (see count_files)
+        self._counts = {}
+
+    def count_files(self, paths: list, pool=None, chunksize: int = CHUNK_SIZE, range_size: int = RANGE_SIZE) -> dict:
+        """
+        Returns the AGGREGATES of the trips of the files, the files are read by chunks
+        (see data_pipeline) so the memory does not depend on their size
+        The counts are kept until the AGGREGATES are cached (see aggregate) so they are
+        counted in one pass
+        """
+        key = tuple(paths)
+        if key not in self._counts:
+            nb_stations = len(self.stations)
+            counts = data_pipeline.aggregate_files(
+                paths,
+                partial(count_trips, pk_to_idx=self.pk_to_idx, nb_stations=nb_stations),
+                partial(merge_counts, nb_stations=nb_stations),
+                usecols=TRIPS_USECOLS,
+                pool=pool,
+                chunksize=chunksize,
+                range_size=range_size,
+            )
+            if counts is None:
+                counts = count_trips(
+                    pd.DataFrame(columns=["start_date", *TRIPS_COLUMNS.values()]),
+                    self.pk_to_idx,
+                    nb_stations,
+                )
+            self._counts[key] = counts
+        return self._counts[key]
+
+    def clear_counts(self):
+        self._counts.clear()
+
+    def aggregate(self, name: str) -> np.ndarray:
+        """
+        Returns the aggregate name of the trips, cached as <year>_<name>. When trips
+        files are added to the year, only the new files are counted and merged
+        The other AGGREGATES counted in the same pass are cached with it, then the
+        counts are cleared
+        """
+        array = self._load_aggregate(name)
+        if self._counts:
+            for other in AGGREGATES:
+                paths = self.paths_to_count(other)
+                if paths is not None and tuple(paths) in self._counts:
+                    self._load_aggregate(other)
+            self.clear_counts()
+        return array
+
+    def _load_aggregate(self, name: str) -> np.ndarray:
+        def build():
+            return self.count_files(self.trips_paths)[name]
+
+        def update(array, new_paths):
+            return merge_counts(
+                {name: array}, {name: self.count_files(new_paths)[name]}, len(self.stations)
+            )[name]
+
+        return data_cache.load_cached_array(
+            self.source_paths(), f"{self.year}_{name}", build, self.cache_dir, update=update
+        )
+
+    def paths_to_count(self, name: str):
+        """
+        Returns the trips files aggregate(name) has to count (all the files, or the
+        files added since it was cached), None if its cache is up to date
+        """
+        sources = self.source_paths()
+        cached = data_cache.cached_sources(sources, f"{self.year}_{name}", self.cache_dir)
+        if cached == sources:
+            return None
+        return self.trips_paths if cached is None else [path for path in sources if path not in cached]
+
+    def source_paths(self) -> list:
+        return self.trips_paths + [self.stations_path]
+
+    def prepare(self, pool=None, chunksize: int = CHUNK_SIZE, range_size: int = RANGE_SIZE, cached_only: bool = False):
+        """
+        Build or update the cached AGGREGATES: the files they need are counted once,
+        by byte ranges in pool if given
+        With cached_only, the AGGREGATES never cached are not built (they are built
+        when the year is first opened)
+        """
+        names = [
+            name for name in AGGREGATES
+            if not cached_only or data_cache.has_cache(f"{self.year}_{name}", self.cache_dir)
+        ]
+        for name in names:
+            paths = self.paths_to_count(name)
+            if paths is not None:
+                self.count_files(paths, pool, chunksize, range_size)
+
+        for name in names:
+            self.aggregate(name)
+
+    def month_counts(self) -> np.ndarray:
+        """
+        Returns the number of trajets per month (rows 1 to 12, row 0 is empty)
+        and station (columns, same order as self.stations)
+        """
+        return self.aggregate("month_counts")
+
+    def time_counts(self) -> np.ndarray:
+        """
+        Returns the number of trajets per month (1 to 12, 0 is empty), day of week
+        (0 is Monday), hour of the start and station (same order as self.stations)
+        """
+        return self.aggregate("time_counts")
+
+    def od_pairs(self) -> np.ndarray:
+        """
+        Returns the (pickup station, dropoff station, nb of trajets) pairs of the year
+        as a 3 x nb_pairs array (stations as rows of self.stations)
+        """
+        return self.aggregate("od_pairs")
+
+
+def count_trips(df: pd.DataFrame, pk_to_idx: np.ndarray, nb_stations: int) -> dict:
+    """
+    Returns the AGGREGATES of raw trips (a chunk of a trips file) with the stations as
+    the rows of the stations of the year (pk_to_idx)
+    """
+    trips = clean_trips(df)
+    origin = lookup(pk_to_idx, trips["emplacement_pk_start"])
+    dest = lookup(pk_to_idx, trips["emplacement_pk_end"])
+
+    known = origin >= 0
+    bins = (
+        trips["Month"].to_numpy(dtype=np.intp)[known] * len(DAYS)
+        + trips["Day"].cat.codes.to_numpy(dtype=np.intp)[known]
+    ) * NB_HOURS + trips["Hour"].to_numpy(dtype=np.intp)[known]
+    shape = (NB_MONTHS + 1, len(DAYS), NB_HOURS, nb_stations)
+    time_counts = (
+        np.bincount(bins * nb_stations + origin[known], minlength=np.prod(shape))
+        .reshape(shape)
+        .astype(np.int32)
+    )
+
+    known &= dest >= 0
+    return {
+        "month_counts": time_counts.sum(axis=(1, 2), dtype=np.int32),
+        "time_counts": time_counts,
+        "od_pairs": sum_pairs(origin[known], dest[known], 1, nb_stations),
+    }
+
+
+def merge_counts(counts: dict, other: dict, nb_stations: int) -> dict:
+    """
+    Returns the sum of two AGGREGATES (only the aggregates of counts)
+    """
+    merged = {}
+    for name, array in counts.items():
+        if name == "od_pairs":
+            origin, dest, nb = np.hstack([array, other[name]])
+            merged[name] = sum_pairs(origin, dest, nb, nb_stations)
+        else:
+            merged[name] = np.add(array, other[name])
+    return merged
+
+
+def sum_pairs(origin, dest, nb, nb_stations: int) -> np.ndarray:
+    """
+    Returns the (origin, dest, sum of nb) pairs with at least one trajet
+    as a 3 x nb_pairs array, nb is an array or 1 for each pair
+    """
+    counts = np.bincount(
+        np.asarray(origin, dtype=np.int64) * nb_stations + dest,
+        weights=None if np.isscalar(nb) else nb,
+        minlength=nb_stations * nb_stations,
+    )
+    keys = np.flatnonzero(counts)
+    origin, dest = np.divmod(keys, nb_stations)
+    return np.vstack([origin, dest, counts[keys]]).astype(np.int32)
+
+
+def find_partitions(data_path: str = DATA_PATH) -> dict:
+    """
+    Returns the YearPartition of each year with trips and stations files in data_path
+    """
+    partitions = {}
+    for stations_path in glob.glob(os.path.join(data_path, "*_stations.csv")):
+        match = re.fullmatch(r"(\d{4})_stations\.csv", os.path.basename(stations_path))
+        if not match:
+            continue
+        year = int(match.group(1))
+        trips_path = os.path.join(data_path, f"{year}_donnees_ouvertes.csv")
+        if os.path.exists(trips_path):
+            partitions[year] = ([trips_path], stations_path)
+
+    for stations_path in glob.glob(os.path.join(data_path, "Stations_*.csv")):
+        match = re.fullmatch(r"Stations_(\d{4})\.csv", os.path.basename(stations_path))
+        if not match or int(match.group(1)) in partitions:
+            continue
+        year = int(match.group(1))
+        trips_paths = sorted(glob.glob(os.path.join(data_path, f"OD_{year}*.csv")))
+        if trips_paths:
+            partitions[year] = (trips_paths, stations_path)
+
+    return {
+        year: YearPartition(year, *paths, data_cache.cache_dir(data_path))
+        for year, paths in sorted(partitions.items())
+    }
+
+
+class TripsDataset:
+    """
+    All the years of trips with a shared station dimension
+    """
+
+    def __init__(self, data_path: str = DATA_PATH) -> None:
+        self.partitions = find_partitions(data_path)
+        self.cache_dir = data_cache.cache_dir(data_path)
+        if not self.partitions:
+            raise FileNotFoundError(f"No Bixi trips and stations files in {data_path}")
+        self.years = list(self.partitions)
+
+        # Station dimension shared by all years, matched by name (or location if renamed)
+        self.registry = StationRegistry(self.partitions)
+        self.stations = self.registry.stations
+
+        # Cumulative month x station counts of the years already asked by the timeline
+        self.month_cubes = {}
+        # Cumulative month x day x hour x station counts, for the filters of the timeline
+        self.time_cubes = {}
+
+    def month_counts(self, year: int) -> np.ndarray:
+        """
+        Returns the number of trajets of the year per month (rows 1 to 12, row 0 is
+        empty) and station pk (columns)
+        """
+        partition = self.partitions[year]
+        counts = np.zeros((NB_MONTHS + 1, len(self.stations)), dtype=np.int32)
+        # Several local stations can be the same station
+        np.add.at(counts.T, partition.idx_to_global, partition.month_counts().T)
+        return counts
+
+    def month_cube(self, year: int) -> np.ndarray:
+        """
+        Returns the cumulative number of trajets of the year per month and station:
+        cube[m, pk] = nb of trajets from station pk between January and month m
+        """
+        if year not in self.month_cubes:
+            self.month_cubes[year] = data_cache.load_cached_array(
+                self.source_paths(year),
+                f"{year}_month_cube",
+                lambda: np.cumsum(self.month_counts(year), axis=0, dtype=np.int32),
+                self.cache_dir,
+            )
+        return self.month_cubes[year]
+
+    def time_cube(self, year: int) -> np.ndarray:
+        """
+        Returns the cumulative number of trajets of the year per month, day of week,
+        hour and station: cube[m, d, h, pk] = nb of trajets from station pk between
+        January and month m on day d at hour h
+        """
+        if year not in self.time_cubes:
+
+            def build():
+                partition = self.partitions[year]
+                local = partition.time_counts()
+                counts = np.zeros(local.shape[:-1] + (len(self.stations),), dtype=np.int32)
+                # Several local stations can be the same station
+                np.add.at(
+                    counts.reshape(-1, len(self.stations)).T,
+                    partition.idx_to_global,
+                    local.reshape(-1, local.shape[-1]).T,
+                )
+                return np.cumsum(counts, axis=0, dtype=np.int32)
+
+            self.time_cubes[year] = data_cache.load_cached_array(
+                self.source_paths(year), f"{year}_time_cube", build, self.cache_dir
+            )
+        return self.time_cubes[year]
+
+    def od_index(self, year: int) -> ODIndex:
+        """
+        Returns the origin-destination index of the year with the pks of the shared
+        station dimension
+        """
+        partition = self.partitions[year]
+
+        def build():
+            origin, dest, nb = partition.od_pairs()
+            return ODIndex.from_pairs(
+                partition.idx_to_global[origin],
+                partition.idx_to_global[dest],
+                nb,
+                len(self.stations),
+            ).to_array()
+
+        array = data_cache.load_cached_array(
+            self.source_paths(year), f"{year}_od_index", build, self.cache_dir
+        )
+        return ODIndex.from_array(array, len(self.stations))
+
+    def source_paths(self, year: int) -> list:
+        """
+        Returns the files the arrays of the year with the shared station pks depend on:
+        the trips of the year and the stations of all years
+        """
+        return self.partitions[year].trips_paths + [
+            partition.stations_path for partition in self.partitions.values()
+        ]
+
+    def prepare(self, pool=None, chunksize: int = CHUNK_SIZE, range_size: int = RANGE_SIZE, cached_only: bool = False):
+        """
+        Build the cached arrays of all the years, so the processes serving the app
+        only memory-map them. The trips files are counted by chunks, by byte ranges
+        in pool (a concurrent.futures executor) if given (see data_pipeline)
+        With cached_only, only the arrays already cached are updated (e.g. when files
+        are added while the app runs, the years never opened are not read)
+        """
+        for partition in self.partitions.values():
+            partition.prepare(pool, chunksize, range_size, cached_only)
+        for year in self.years:
+            for name, load in [
+                ("month_cube", self.month_cube),
+                ("time_cube", self.time_cube),
+                ("od_index", self.od_index),
+            ]:
+                if not cached_only or data_cache.has_cache(f"{year}_{name}", self.cache_dir):
+                    load(year)
+
+
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    TripsDataset().prepare()
+    print(
+        f"Data prepared! Time needed: {time.perf_counter() - start_time:.1f} s, "
+        f"resident memory: {resident_memory():.0f} MB"
+    )
@@ -0,0 +1,152 @@
+'''
+Asyncio collector of GBFS feeds (station_status, station_information, other systems...)
+
+All the feeds are polled concurrently on one event loop with a pooled HTTP client.
+A feed is requested again when its data expires (last_updated + ttl), with
+If-None-Match/If-Modified-Since headers, and unchanged payloads are skipped.
+'''
+
+import asyncio
+import json
+import time
+
+import aiohttp
+
+# Bixi GBFS auto-discovery file
+BIXI_GBFS_URL = "https://gbfs.velobixi.com/gbfs/gbfs.json"
+
+# Default min time between two requests of a feed (s), even if its ttl is 0
+MIN_INTERVAL = 1
+
+
+class Feed:
+    def __init__(self, name: str, url: str, on_update, min_interval: float = MIN_INTERVAL, max_interval: float = 300) -> None:
+        '''
+        on_update(feed, data) is called with the decoded json each time the feed changes
+        '''
+        self.name = name
+        self.url = url
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        # State of the last response
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.last_updated = None
+        self.ttl = 0
+
+        # Counters
+        self.nb_requests = 0
+        self.nb_updates = 0
+        self.nb_unchanged = 0
+        self.nb_errors = 0
+
+    def next_delay(self, now: float) -> float:
+        '''
+        Time to wait before the next request: until the data expires (last_updated + ttl)
+        but at least min_interval and at most max_interval
+        '''
+        if self.last_updated is None:
+            return self.min_interval
+        delay = self.last_updated + self.ttl - now
+        return min(max(delay, self.min_interval), self.max_interval)
+
+    def stats(self) -> dict:
+        return {"name": self.name, "requests": self.nb_requests, "updates": self.nb_updates,
+                "unchanged": self.nb_unchanged, "errors": self.nb_errors}
+
+
+class GBFSCollector:
+    def __init__(self, feeds: list, max_connections: int = 20, timeout: float = 10) -> None:
+        self.feeds = feeds
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+    async def run(self, collect_time: float = 0):
+        '''
+        Poll all the feeds concurrently. If collect_time is negative or null, infinite collect
+        '''
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [asyncio.create_task(self.poll(session, feed)) for feed in self.feeds]
+            try:
+                if collect_time > 0:
+                    await asyncio.wait(tasks, timeout=collect_time)
+                else:
+                    await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def poll(self, session: aiohttp.ClientSession, feed: Feed):
+        while True:
+            await self.fetch(session, feed)
+            await asyncio.sleep(feed.next_delay(time.time()))
+
+    async def fetch(self, session: aiohttp.ClientSession, feed: Feed):
+        '''
+        Request the feed and call feed.on_update if the data changed
+        '''
+        headers = {}
+        if feed.etag:
+            headers["If-None-Match"] = feed.etag
+        if feed.last_modified:
+            headers["If-Modified-Since"] = feed.last_modified
+
+        feed.nb_requests += 1
+        try:
+            async with session.get(feed.url, headers=headers) as response:
+                if response.status == 304:
+                    feed.nb_unchanged += 1
+                    return
+                response.raise_for_status()
+                body = await response.read()
+                feed.etag = response.headers.get("ETag")
+                feed.last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            feed.nb_errors += 1
+            print(f"Error while getting {feed.name} ({feed.url}): {e!r}")
+            return
+
+        # Same payload (server without ETag): skip the json decoding
+        body_hash = hash(body)
+        if body_hash == feed.body_hash:
+            feed.nb_unchanged += 1
+            return
+
+        # A bad payload (e.g. an html error page) or an error of on_update only counts
+        # as an error of this feed, the feed and the other feeds keep being polled
+        try:
+            data = json.loads(body)
+            feed.ttl = data.get("ttl", 0)
+            last_updated = data.get("last_updated")
+            if last_updated is not None and last_updated == feed.last_updated:
+                feed.body_hash = body_hash
+                feed.nb_unchanged += 1
+                return
+            feed.on_update(feed, data)
+        except Exception as e:
+            # The etag and hash are not kept, so the payload is requested and handled again
+            feed.etag = feed.last_modified = None
+            feed.nb_errors += 1
+            print(f"Error while handling {feed.name} ({feed.url}): {e!r}")
+            return
+        feed.body_hash = body_hash
+        feed.last_updated = last_updated
+        feed.nb_updates += 1
+
+
+async def discover_feeds(gbfs_url: str = BIXI_GBFS_URL, language: str = "fr", names=("station_status", "station_information")) -> dict:
+    '''
+    Returns the url of the feeds of a GBFS system from its gbfs.json auto-discovery file
+    '''
+    async with aiohttp.ClientSession() as session:
+        async with session.get(gbfs_url) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+    feeds = data["data"][language]["feeds"]
+    return {feed["name"]: feed["url"] for feed in feeds if feed["name"] in names}
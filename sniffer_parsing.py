@@ -0,0 +1,134 @@
+'''
+Vectorized parsing of the GBFS station_status payloads
+
+The stations of a payload are decoded directly into typed numpy columns (no DataFrame
+per tick), the epochs are cast to datetime64 and the availability matrices are
+built with one scatter into arrays indexed by station_id.
+The GBFS station_ids are strings, they are stored as integers through StationIds.
+'''
+
+import json
+import os
+from operator import itemgetter
+
+import numpy as np
+
+# Columns of a decoded station_status: GBFS field, numpy type
+STATION_STATUS_FIELDS = {
+    "station_id": ("station_id", np.int32),
+    "bikes": ("num_bikes_available", np.int16),
+    "ebikes": ("num_ebikes_available", np.int16),
+    "docks": ("num_docks_available", np.int16),
+    "last_reported": ("last_reported", np.int64),
+}
+
+# Optional GBFS fields, missing in some systems
+OPTIONAL_FIELDS = {"num_ebikes_available"}
+
+# File of the StationIds in the sniffer result folder
+STATION_IDS_FILE = "station_ids.json"
+
+
+class StationIds:
+    def __init__(self, path: str = None) -> None:
+        '''
+        Integer of each GBFS station_id (a string, not always a number): the numeric ids
+        keep their value (e.g. Bixi), the others get the next free integer.
+        The integers are saved in path when ids are added, so the station_ids of the
+        stored snapshots and of the station_information stay the same between runs
+        '''
+        self.path = path
+        self.index = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.index = json.load(f)
+        self.used = set(self.index.values())
+
+    def encode(self, ids) -> np.ndarray:
+        '''
+        Returns the integers of the ids, the new ids are added
+        '''
+        ids = list(map(str, ids))
+        try:
+            return np.fromiter(map(self.index.__getitem__, ids), dtype=np.int32, count=len(ids))
+        except KeyError:
+            for station_id in ids:
+                if station_id not in self.index:
+                    self.add(station_id)
+            self.save()
+            return np.fromiter(map(self.index.__getitem__, ids), dtype=np.int32, count=len(ids))
+
+    def lookup(self, ids) -> np.ndarray:
+        '''
+        Returns the integers of the ids, -1 for the unknown ids
+        '''
+        return np.fromiter((self.index.get(str(station_id), -1) for station_id in ids), dtype=np.int32, count=len(ids))
+
+    def add(self, station_id: str):
+        value = int(station_id) if station_id.isdigit() else None
+        if value is None or value in self.used or value > np.iinfo(np.int32).max:
+            value = max(self.used, default=-1) + 1
+        self.index[station_id] = value
+        self.used.add(value)
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def decode_column(stations: list, field: str, dtype, station_ids: StationIds = None) -> np.ndarray:
+    if field in OPTIONAL_FIELDS:
+        values = (station.get(field, 0) for station in stations)
+    else:
+        values = map(itemgetter(field), stations)
+    if field == "station_id":
+        # GBFS ids are strings
+        return (StationIds() if station_ids is None else station_ids).encode(values).astype(dtype, copy=False)
+    return np.fromiter(values, dtype=dtype, count=len(stations))
+
+
+def decode_station_status(data: dict, station_ids: StationIds = None) -> dict:
+    '''
+    Returns the station_status payload as typed numpy columns (see STATION_STATUS_FIELDS)
+    plus the scalar time of the payload. Only the stations renting and returning
+    bikes are kept, a station reported twice with the same last_reported is kept once
+    The station_ids are encoded by station_ids (the same for all the payloads of a
+    system, a new StationIds if None)
+    '''
+    stations = data["data"]["stations"]
+    nb_stations = len(stations)
+    active = (np.fromiter(map(itemgetter("is_renting"), stations), dtype=np.int8, count=nb_stations) == 1) \
+        & (np.fromiter(map(itemgetter("is_returning"), stations), dtype=np.int8, count=nb_stations) == 1)
+
+    columns = {name: decode_column(stations, field, dtype, station_ids)[active]
+               for name, (field, dtype) in STATION_STATUS_FIELDS.items()}
+
+    # Drop the duplicated (station_id, last_reported), keep the first one
+    keys = (columns["station_id"].astype(np.int64) << 32) | columns["last_reported"]
+    _, first = np.unique(keys, return_index=True)
+    if len(first) < len(keys):
+        first.sort()
+        columns = {name: values[first] for name, values in columns.items()}
+
+    columns["last_reported"] = columns["last_reported"].astype("datetime64[s]")
+    columns["time"] = np.datetime64(int(data["last_updated"]), "s")
+    return columns
+
+
+def availability_matrix(columns: dict, values=("bikes", "ebikes")):
+    '''
+    Returns the sorted station_ids and a (len(values), nb_stations) matrix of the values
+    of each station, built with one scatter into an array indexed by station_id
+    '''
+    station_id = columns["station_id"]
+    size = int(station_id.max()) + 1 if len(station_id) else 0
+    matrix = np.zeros((len(values), size), dtype=np.int16)
+    matrix[:, station_id] = np.stack([columns[value] for value in values])
+
+    present = np.zeros(size, dtype=bool)
+    present[station_id] = True
+    station_ids = np.flatnonzero(present)
+    return station_ids, matrix[:, station_ids]
@@ -0,0 +1,104 @@
+'''
+Local stand-in of GBFS servers to run and test the collector without the Bixi API
+
+Serves /<system>/gbfs.json, /<system>/fr/station_status.json and
+/<system>/fr/station_information.json for each system, with ETag and 304 responses.
+The station status of a system changes every update_every seconds.
+
+python sniffer_stand_in.py  ->  http://localhost:8080/bixi/gbfs.json
+'''
+
+import hashlib
+import json
+import time
+
+import numpy as np
+from aiohttp import web
+
+HOST = "localhost"
+PORT = 8080
+
+
+class StandInSystem:
+    def __init__(self, name: str, nb_stations: int, update_every: float, ttl: int, seed: int = 0) -> None:
+        self.name = name
+        self.nb_stations = nb_stations
+        self.update_every = update_every
+        self.ttl = ttl
+        self.rng = np.random.default_rng(seed)
+
+        self.capacity = self.rng.integers(10, 40, nb_stations)
+        self.bikes = self.rng.integers(0, self.capacity + 1)
+        self.ebikes = self.rng.integers(0, self.bikes // 3 + 1)
+        self.last_reported = np.full(nb_stations, int(time.time()))
+        self.last_updated = int(time.time())
+
+        self.information = self.encode({
+            "last_updated": self.last_updated, "ttl": 3600,
+            "data": {"stations": [
+                {"station_id": str(i + 1), "name": f"{name} station {i + 1}",
+                 "lat": 45.5 + self.rng.normal(0, 0.05), "lon": -73.6 + self.rng.normal(0, 0.05),
+                 "capacity": int(self.capacity[i])}
+                for i in range(nb_stations)]}})
+        self.status = None
+        self.update()
+
+    @staticmethod
+    def encode(data: dict):
+        body = json.dumps(data).encode()
+        return body, '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+    def update(self):
+        '''
+        Some stations get or lose a bike, like the real stations between two polls
+        '''
+        now = int(time.time())
+        changed = self.rng.random(self.nb_stations) < 0.1
+        delta = self.rng.integers(-1, 2, self.nb_stations) * changed
+        self.bikes = np.clip(self.bikes + delta, 0, self.capacity)
+        self.ebikes = np.minimum(self.ebikes, self.bikes)
+        self.last_reported[changed] = now
+        self.last_updated = now
+
+        self.status = self.encode({
+            "last_updated": now, "ttl": self.ttl,
+            "data": {"stations": [
+                {"station_id": str(i + 1), "num_bikes_available": int(self.bikes[i]),
+                 "num_ebikes_available": int(self.ebikes[i]), "num_bikes_disabled": 0,
+                 "num_docks_available": int(self.capacity[i] - self.bikes[i]), "num_docks_disabled": 0,
+                 "is_installed": 1, "is_renting": 1, "is_returning": 1,
+                 "last_reported": int(self.last_reported[i])}
+                for i in range(self.nb_stations)]}})
+
+    def feed(self, name: str):
+        if name == "station_status":
+            if time.time() - self.last_updated >= self.update_every:
+                self.update()
+            return self.status
+        return self.information
+
+
+def create_app(systems: list) -> web.Application:
+    systems = {system.name: system for system in systems}
+
+    async def gbfs(request):
+        base = f"http://{request.host}/{request.match_info['system']}/fr"
+        return web.json_response({"last_updated": int(time.time()), "ttl": 0, "data": {"fr": {"feeds": [
+            {"name": "station_status", "url": f"{base}/station_status.json"},
+            {"name": "station_information", "url": f"{base}/station_information.json"}]}}})
+
+    async def feed(request):
+        system = systems[request.match_info["system"]]
+        body, etag = system.feed(request.match_info["feed"])
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/{system}/gbfs.json", gbfs)
+    app.router.add_get("/{system}/fr/{feed}.json", feed)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app([StandInSystem("bixi", 800, update_every=10, ttl=10)]), host=HOST, port=PORT)
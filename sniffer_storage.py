@@ -0,0 +1,254 @@
+'''
+Append-only columnar storage of the Bixi station status snapshots
+
+Each snapshot is appended in long format (time, station_id, bikes, ebikes, docks,
+last_reported, keyframe) to preallocated buffers. A full buffer is written as one
+compressed row group of a .parquet file, and a new file is started every
+row_groups_per_file row groups (or max_file_age seconds), so memory stays the same
+however long the sniffer runs. A file is written as .tmp and renamed when it is complete,
+so readers (e.g. the live layer of the app) only see complete files.
+
+With a DeltaEncoder only the stations that changed since the previous snapshot are
+stored, plus a keyframe (all the stations) every keyframe_every snapshots.
+read_state and read_matrix rebuild the availability at any time from the last keyframe.
+'''
+
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columns of the snapshots and their type in the buffers
+COLUMNS = {
+    "time": "datetime64[s]",
+    "station_id": np.int32,
+    "bikes": np.int16,
+    "ebikes": np.int16,
+    "docks": np.int16,
+    "last_reported": "datetime64[s]",
+    "keyframe": bool,
+}
+
+# Columns with the availability of a station
+VALUES = ["bikes", "ebikes", "docks"]
+
+SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("s", tz="UTC")),
+        ("station_id", pa.int32()),
+        ("bikes", pa.int16()),
+        ("ebikes", pa.int16()),
+        ("docks", pa.int16()),
+        ("last_reported", pa.timestamp("s", tz="UTC")),
+        ("keyframe", pa.bool_()),
+    ]
+)
+
+
+class SnapshotWriter:
+    def __init__(self, result_path: str, row_group_size: int, row_groups_per_file: int, prefix: str = "Snapshots",
+                 max_file_age: float = None) -> None:
+        '''
+        If max_file_age (s) is set, the rows are written and the file closed when its first row
+        is older than max_file_age, so the data can be read before row_groups_per_file row groups
+        '''
+        self.result_path = result_path
+        os.makedirs(self.result_path, exist_ok=True)
+        self.prefix = prefix
+
+        self.row_group_size = row_group_size
+        self.row_groups_per_file = row_groups_per_file
+        self.max_file_age = max_file_age
+        self._file_start = None
+
+        # Continue the numbering of the files already saved
+        self.nb_files = len(glob.glob(os.path.join(self.result_path, f"{prefix}_*.parquet")))
+        self.nb_row_groups = 0
+        self._writer = None
+
+        self.buffers = {name: np.empty(row_group_size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.nb_rows = 0
+
+    def append(self, **columns):
+        '''
+        Append the rows of a snapshot, each column is a scalar (e.g. time) or an array
+        Full buffers are written to disk
+        '''
+        if self._file_start is None:
+            self._file_start = time.monotonic()
+        self._append(columns)
+        if self.max_file_age is not None and time.monotonic() - self._file_start >= self.max_file_age:
+            self.flush()
+            self.close_file()
+
+    def _append(self, columns: dict):
+        # Scalars (e.g. time) are repeated, a snapshot without change has no row
+        nb_rows = max((np.size(values) for values in columns.values() if np.ndim(values)), default=1)
+        written = 0
+        while written < nb_rows:
+            size = min(nb_rows - written, self.row_group_size - self.nb_rows)
+            for name, buffer in self.buffers.items():
+                values = columns[name]
+                if np.ndim(values):
+                    values = values[written:written + size]
+                buffer[self.nb_rows:self.nb_rows + size] = values
+            self.nb_rows += size
+            written += size
+
+            if self.nb_rows == self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        Write the rows of the buffers as a row group
+        '''
+        if not self.nb_rows:
+            return
+
+        if self._writer is None:
+            self.nb_files += 1
+            self._writer = pq.ParquetWriter(self.file_path(self.nb_files) + ".tmp", SCHEMA, compression="zstd")
+
+        table = pa.Table.from_arrays(
+            [pa.array(self.buffers[name][:self.nb_rows], type=field.type) for name, field in zip(COLUMNS, SCHEMA)],
+            schema=SCHEMA,
+        )
+        self._writer.write_table(table, row_group_size=self.nb_rows)
+        self.nb_rows = 0
+        self.nb_row_groups += 1
+
+        # Close the file (write its footer) after row_groups_per_file row groups
+        if self.nb_row_groups == self.row_groups_per_file:
+            self.close_file()
+
+    def close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.file_path(self.nb_files) + ".tmp", self.file_path(self.nb_files))
+            self._writer = None
+            self.nb_row_groups = 0
+        self._file_start = None
+
+    def close(self):
+        '''
+        Write the remaining rows and close the current file
+        '''
+        self.flush()
+        self.close_file()
+
+    def file_path(self, nb_file: int) -> str:
+        return snapshot_path(self.result_path, nb_file, self.prefix)
+
+
+class DeltaEncoder:
+    def __init__(self, keyframe_every: int) -> None:
+        '''
+        Keep the last state of each station_id to only store the changes.
+        A keyframe (all the stations) is stored every keyframe_every snapshots,
+        every snapshot is a keyframe if keyframe_every <= 1
+        '''
+        self.keyframe_every = keyframe_every
+        self.nb_snapshots = 0
+
+        # Last stored state, indexed by station_id
+        self.values = np.full((0, len(VALUES)), -1, dtype=np.int16)
+        self.last_reported = np.zeros(0, dtype="datetime64[s]")
+
+    def encode(self, station_id: np.ndarray, values: np.ndarray, last_reported: np.ndarray):
+        '''
+        Returns the mask of the stations to store and if the snapshot is a keyframe
+        values: one row per station with the columns of VALUES
+        A station is stored if it reported since its last stored state (last_reported)
+        with a different availability
+        '''
+        if len(station_id) and station_id.max() >= len(self.values):
+            size = station_id.max() + 1
+            self.values = np.vstack([self.values, np.full((size - len(self.values), len(VALUES)), -1, dtype=np.int16)])
+            self.last_reported = np.concatenate([self.last_reported, np.zeros(size - len(self.last_reported), dtype="datetime64[s]")])
+
+        keyframe = self.keyframe_every <= 1 or self.nb_snapshots % self.keyframe_every == 0
+        self.nb_snapshots += 1
+
+        newer = last_reported > self.last_reported[station_id]
+        if keyframe:
+            keep = np.ones(len(station_id), dtype=bool)
+        else:
+            keep = newer & (values != self.values[station_id]).any(axis=1)
+
+        self.values[station_id[keep]] = values[keep]
+        self.last_reported[station_id[newer]] = last_reported[newer]
+        return keep, keyframe
+
+
+def snapshot_path(result_path: str, nb_file: int, prefix: str = "Snapshots") -> str:
+    '''
+    Returns the path of the file number nb_file (files are numbered from 1)
+    '''
+    return os.path.join(result_path, f"{prefix}_{str(nb_file).zfill(3)}.parquet")
+
+
+def snapshot_files(result_path: str, prefix: str = "Snapshots") -> list:
+    '''
+    Returns the readable .parquet files (files of a sniffer killed before its close have no footer)
+    '''
+    files = []
+    for path in sorted(glob.glob(os.path.join(result_path, f"{prefix}_*.parquet"))):
+        try:
+            pq.read_metadata(path)
+        except (pa.ArrowInvalid, OSError):
+            continue
+        files.append(path)
+    return files
+
+
+def read_state(result_path: str, at, prefix: str = "Snapshots") -> pd.DataFrame:
+    '''
+    Returns the availability of each station (index station_id) at the time at,
+    from the last keyframe before at and the changes after it
+    '''
+    at = to_utc(at)
+    dataset = ds.dataset(snapshot_files(result_path, prefix), schema=SCHEMA, format="parquet")
+
+    # Row groups statistics skip the row groups without keyframe or after at
+    keyframes = dataset.to_table(columns=["time"], filter=ds.field("keyframe") & (ds.field("time") <= at))
+    time_filter = ds.field("time") <= at
+    if keyframes.num_rows:
+        time_filter &= ds.field("time") >= pc.max(keyframes["time"])
+
+    rows = dataset.to_table(columns=["time", "station_id", *VALUES, "last_reported"], filter=time_filter).to_pandas()
+    rows = rows.sort_values("time", kind="stable").drop_duplicates("station_id", keep="last")
+    return rows.set_index("station_id").sort_index()
+
+
+def read_matrix(result_path: str, start, end, value: str = "bikes", prefix: str = "Snapshots") -> pd.DataFrame:
+    '''
+    Returns the value (bikes, ebikes or docks) of each station (columns) at each
+    snapshot time between start and end (index), like the wide csv files of the sniffer
+    '''
+    start, end = to_utc(start), to_utc(end)
+    state = read_state(result_path, start, prefix)
+
+    dataset = ds.dataset(snapshot_files(result_path, prefix), schema=SCHEMA, format="parquet")
+    changes = dataset.to_table(columns=["time", "station_id", value],
+                               filter=(ds.field("time") > start) & (ds.field("time") <= end)).to_pandas()
+
+    matrix = changes.pivot_table(index="time", columns="station_id", values=value, aggfunc="last")
+    first = state[value].to_frame(start).T
+    matrix = pd.concat([first, matrix]).sort_index().ffill()
+    matrix.index.name = "time"
+    matrix.columns.name = "station_id"
+    return matrix
+
+
+def to_utc(timestamp) -> pd.Timestamp:
+    '''
+    Returns the timestamp in UTC (naive timestamps are UTC)
+    '''
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
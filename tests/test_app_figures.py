@@ -0,0 +1,93 @@
+'''
+Points of the stations map (app_figures.Data.get_map_points) on synthetic data
+
+python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+sys.path.insert(0, os.path.join(ROOT_PATH, "benchmarks"))
+
+import app_figures  # noqa: E402
+from synthetic_trips import write_dataset  # noqa: E402
+
+NB_STATIONS = 300
+
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    data_path = tmp_path_factory.mktemp("data")
+    stations_path, trips_path = write_dataset(str(data_path), scale=0.005, nb_stations=NB_STATIONS)
+    # The two busiest stations are at -1, -1 in the open data, one has a known location
+    busiest = pd.read_csv(trips_path)["emplacement_pk_start"].value_counts().index[:2]
+    stations = pd.read_csv(stations_path)
+    rows = stations.index[stations["pk"].isin(busiest)]
+    stations.loc[rows, ["latitude", "longitude"]] = -1
+    stations.loc[rows[1], "name"] = "Peel / Smith"
+    stations.loc[rows[0], "name"] = "Unlocated"
+    stations.to_csv(stations_path, index=False)
+    return app_figures.Data(str(data_path))
+
+
+def test_points_of_the_viewport(data):
+    period = (data.min_period_idx, data.max_period_idx)
+    counts = data.get_deplacements_count(*period)
+    located = np.isfinite(data.bixi_stations["latitude"].to_numpy())
+    points, nb_active = data.get_map_points(*period, NB_STATIONS)
+    assert nb_active == np.count_nonzero(counts[located]) == len(points)
+    assert (points["pk"] >= 0).all() and points["nb_trajets"].sum() == counts[located].sum()
+
+    latitude, longitude = points["latitude"].median(), points["longitude"].median()
+    bounds = (longitude - 0.05, latitude - 0.03, longitude + 0.05, latitude + 0.03)
+    inside, _ = data.get_map_points(*period, NB_STATIONS, bounds)
+    assert 0 < len(inside) < len(points)
+    assert inside["longitude"].between(bounds[0], bounds[2]).all()
+    assert inside["latitude"].between(bounds[1], bounds[3]).all()
+
+
+def test_clusters_keep_the_number_of_trajets(data, monkeypatch):
+    period = (data.min_period_idx, data.max_period_idx)
+    points, _ = data.get_map_points(*period, NB_STATIONS)
+    max_points = len(points) // 4
+    monkeypatch.setattr(app_figures, "MAX_MAP_POINTS", max_points)
+
+    clusters, _ = data.get_map_points(*period, NB_STATIONS)
+    assert len(clusters) <= max_points
+    assert clusters["nb_trajets"].sum() == points["nb_trajets"].sum()
+
+    # A cluster of one station is the station itself
+    single = clusters[clusters["pk"] >= 0]
+    grouped = clusters[clusters["pk"] < 0]
+    assert len(single) and len(grouped)
+    assert grouped["name"].str.endswith(" stations").all()
+    stations = points.set_index("pk")
+    for row in single.itertuples():
+        station = stations.loc[row.pk]
+        assert (row.name, row.nb_trajets) == (station["name"], station["nb_trajets"])
+        assert (row.latitude, row.longitude) == (station["latitude"], station["longitude"])
+    assert clusters["pk"][clusters["pk"] >= 0].is_unique
+
+
+def test_unlocated_stations_are_not_ranked(data):
+    period = (data.min_period_idx, data.max_period_idx)
+    registry = data.dataset.registry
+    (unlocated,), (peel,) = registry.get_pks(["Unlocated", "Peel / Smith"])
+    assert np.isnan(data.bixi_stations.loc[unlocated, "latitude"])
+    assert data.bixi_stations.loc[peel, ["latitude", "longitude"]].tolist() == [45.49277, -73.55641]
+
+    counts = data.get_deplacements_count(*period)
+    assert counts[unlocated] >= np.sort(counts)[-2]
+    # The best stations shown are best stations with a location
+    for best in (1, 10, 50):
+        points, _ = data.get_map_points(*period, best)
+        assert len(points) == best and unlocated not in points["pk"].tolist()
+        assert best == 1 or peel in points["pk"].tolist()
+        ranked = np.delete(counts, unlocated)
+        assert points["nb_trajets"].min() >= np.sort(ranked)[-best]
@@ -0,0 +1,151 @@
+'''
+Cached arrays of data_cache: build, update with added files, invalidation
+
+python -m pytest tests
+'''
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_cache  # noqa: E402
+
+
+def write_sources(path, values: dict) -> list:
+    '''
+    Write one number per source file, returns the paths
+    '''
+    paths = []
+    for name, value in values.items():
+        paths.append(str(path / name))
+        with open(paths[-1], "w") as f:
+            f.write(str(value))
+    return paths
+
+
+def load(paths: list, cache_dir: str, calls: list, delay: float = 0) -> np.ndarray:
+    '''
+    Sum of the numbers of the files, calls records the build and the updates
+    '''
+
+    def total(files):
+        return np.array([sum(int(open(file).read()) for file in files)])
+
+    def build():
+        calls.append("build")
+        time.sleep(delay)
+        return total(paths)
+
+    def update(array, new_paths):
+        calls.append(new_paths)
+        time.sleep(delay)
+        return array + total(new_paths)
+
+    return data_cache.load_cached_array(paths, "sum", build, cache_dir, update=update)
+
+
+def array_files(cache_dir: str) -> list:
+    return sorted(name for name in os.listdir(cache_dir) if name.endswith(".npy"))
+
+
+def test_build_then_memory_map(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1, "b.csv": 2})
+    calls = []
+    assert load(paths, cache_dir, calls)[0] == 3
+    array = load(paths, cache_dir, calls)
+    assert array[0] == 3 and isinstance(array, np.memmap)
+    assert calls == ["build"]
+
+
+def test_added_files_update_the_cached_array(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1, "b.csv": 2})
+    calls = []
+    load(paths, cache_dir, calls)
+    first = array_files(cache_dir)
+
+    paths += write_sources(tmp_path, {"c.csv": 4})
+    assert load(paths, cache_dir, calls)[0] == 7
+    assert calls == ["build", [paths[2]]]
+    assert data_cache.cached_sources(paths, "sum", cache_dir) == paths
+
+    # New version of the array in a new file named in the metadata, the previous one is kept
+    with open(os.path.join(cache_dir, "sum.json")) as f:
+        assert json.load(f)["array"] not in first
+    assert len(array_files(cache_dir)) == 2
+    paths += write_sources(tmp_path, {"d.csv": 8})
+    assert load(paths, cache_dir, calls)[0] == 15
+    assert len(array_files(cache_dir)) == 2 and not set(first) & set(array_files(cache_dir))
+
+
+def test_changed_file_rebuilds_the_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1, "b.csv": 2})
+    calls = []
+    load(paths, cache_dir, calls)
+
+    write_sources(tmp_path, {"a.csv": 10})
+    os.utime(paths[0], ns=(1, 1))
+    assert load(paths, cache_dir, calls)[0] == 12
+    assert calls == ["build", "build"]
+
+
+def test_touched_file_keeps_the_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1})
+    calls = []
+    load(paths, cache_dir, calls)
+
+    # Same content: only the hash is checked again
+    os.utime(paths[0], ns=(1, 1))
+    assert load(paths, cache_dir, calls)[0] == 1
+    assert calls == ["build"]
+
+
+def test_removed_file_invalidates_the_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1, "b.csv": 2})
+    calls = []
+    load(paths, cache_dir, calls)
+
+    os.remove(paths[1])
+    assert data_cache.cached_sources(paths[:1], "sum", cache_dir) is None
+    assert load(paths[:1], cache_dir, calls)[0] == 1
+    assert calls == ["build", "build"]
+
+
+def test_has_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    assert not data_cache.has_cache("sum", cache_dir)
+    load(write_sources(tmp_path, {"a.csv": 1}), cache_dir, [])
+    assert data_cache.has_cache("sum", cache_dir)
+
+
+def load_in_process(paths: list, cache_dir: str) -> tuple:
+    calls = []
+    return int(load(paths, cache_dir, calls, delay=0.2)[0]), calls
+
+
+@pytest.mark.skipif(data_cache.fcntl is None, reason="no file lock on this system")
+def test_one_process_builds_or_updates(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    paths = write_sources(tmp_path, {"a.csv": 1, "b.csv": 2})
+    with ProcessPoolExecutor(4) as pool:
+        results = list(pool.map(load_in_process, [paths] * 4, [cache_dir] * 4))
+    assert [total for total, _ in results] == [3] * 4
+    assert sorted(call for _, calls in results for call in calls) == ["build"]
+
+    # The others wait for the update and do not merge the new file again
+    paths += write_sources(tmp_path, {"c.csv": 4})
+    with ProcessPoolExecutor(4) as pool:
+        results = list(pool.map(load_in_process, [paths] * 4, [cache_dir] * 4))
+    assert [total for total, _ in results] == [7] * 4
+    assert [call for _, calls in results for call in calls] == [[paths[2]]]
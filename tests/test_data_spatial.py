@@ -0,0 +1,61 @@
+'''
+Viewport queries and clusters of the StationGrid (data_spatial)
+
+python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_spatial import UNLOCATED, StationGrid  # noqa: E402
+
+
+def random_stations(nb_stations: int, seed: int = 0):
+    '''
+    Stations around Montreal, some without location (NaN or at -1, -1)
+    '''
+    rng = np.random.default_rng(seed)
+    latitude = 45.5 + rng.normal(0, 0.05, nb_stations)
+    longitude = -73.57 + rng.normal(0, 0.07, nb_stations)
+    latitude[::37] = np.nan
+    latitude[5::41] = longitude[5::41] = UNLOCATED
+    return latitude, longitude
+
+
+def test_query_matches_a_brute_force_mask():
+    latitude, longitude = random_stations(3000)
+    grid = StationGrid(latitude, longitude)
+    located = np.isfinite(latitude) & (latitude != UNLOCATED)
+    assert grid.query().tolist() == np.flatnonzero(located).tolist()
+
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        south, north = np.sort(45.5 + rng.normal(0, 0.06, 2))
+        west, east = np.sort(-73.57 + rng.normal(0, 0.08, 2))
+        with np.errstate(invalid="ignore"):
+            inside = located & (latitude >= south) & (latitude <= north) & (longitude >= west) & (longitude <= east)
+        assert grid.query((west, south, east, north)).tolist() == np.flatnonzero(inside).tolist()
+
+    # Viewport larger than the grid, or without stations
+    assert grid.query((-180, -90, 180, 90)).tolist() == np.flatnonzero(located).tolist()
+    assert len(grid.query((10, 10, 11, 11))) == 0
+
+
+def test_clusters_group_the_stations_by_cell():
+    latitude, longitude = random_stations(500)
+    grid = StationGrid(latitude, longitude)
+    idxs = grid.query()
+    for level in range(4):
+        cluster, nb_clusters = grid.clusters(idxs, level)
+        assert cluster.max() + 1 == nb_clusters
+        cells = list(zip(grid.iy[idxs] >> level, grid.ix[idxs] >> level))
+        assert len(set(cells)) == nb_clusters
+        # Same cluster if and only if same cell
+        for cell in set(cells):
+            members = [i for i, other in enumerate(cells) if other == cell]
+            assert len(set(cluster[members])) == 1
+    assert grid.clusters(idxs[:0], 0)[1] == 0
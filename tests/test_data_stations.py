@@ -0,0 +1,79 @@
+'''
+Matching of the stations of all years in the StationRegistry (data_stations)
+
+python -m pytest tests
+'''
+
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_stations import StationRegistry  # noqa: E402
+
+
+def partition(stations: list) -> SimpleNamespace:
+    '''
+    Partition with the stations [(name, latitude, longitude)] (local pk = row + 1)
+    '''
+    names, latitudes, longitudes = zip(*stations)
+    return SimpleNamespace(stations=pd.DataFrame({
+        "pk": np.arange(1, len(stations) + 1),
+        "name": names,
+        "latitude": latitudes,
+        "longitude": longitudes,
+    }))
+
+
+def test_renamed_station_keeps_its_pk():
+    partitions = {
+        2020: partition([("Old name", 45.5, -73.5), ("Other", 45.6, -73.6)]),
+        2021: partition([("Other", 45.6, -73.6), ("New name", 45.50001, -73.50001)]),
+    }
+    registry = StationRegistry(partitions)
+    assert len(registry) == 2
+    pk = partitions[2021].idx_to_global[1]
+    assert partitions[2020].idx_to_global[0] == pk
+    # Most recent name, both names find the station
+    assert registry.get_names([pk]).tolist() == ["New name"]
+    assert registry.get_pks(["Old name", "New name", "Unknown"]) == [[pk], [pk], []]
+
+
+def test_same_name_twice_in_a_year_is_two_stations():
+    partitions = {
+        2020: partition([("Duplicate", 45.5, -73.5), ("Duplicate", 45.7, -73.7)]),
+        2021: partition([("Duplicate", 45.7, -73.7), ("Duplicate", 45.5, -73.5)]),
+    }
+    registry = StationRegistry(partitions)
+    assert len(registry) == 2
+    assert sorted(registry.get_pks(["Duplicate"])[0]) == [0, 1]
+    # Matched by location between the years
+    assert partitions[2020].idx_to_global.tolist() == partitions[2021].idx_to_global[::-1].tolist()
+
+
+def test_name_reused_across_years_is_the_same_station():
+    partitions = {
+        2019: partition([("Moved", 45.4, -73.4)]),
+        2020: partition([("Moved", 45.6, -73.6), ("Elsewhere", 45.4, -73.4)]),
+        2021: partition([("Moved", 45.5, -73.5)]),
+    }
+    registry = StationRegistry(partitions)
+    pk = partitions[2021].idx_to_global[0]
+    assert partitions[2020].idx_to_global[0] == pk and partitions[2019].idx_to_global[0] == pk
+    # Last location of the station, the station at its old location is another one
+    assert registry.stations.loc[pk, ["latitude", "longitude"]].tolist() == [45.5, -73.5]
+    assert partitions[2020].idx_to_global[1] != pk
+    assert registry.get_pks(["Moved"]) == [[pk]]
+
+
+def test_location_of_a_previous_year():
+    partitions = {
+        2020: partition([("Peel / Smith", 45.49, -73.55)]),
+        2021: partition([("Peel / Smith", np.nan, np.nan)]),
+    }
+    registry = StationRegistry(partitions)
+    assert registry.stations[["latitude", "longitude"]].values.tolist() == [[45.49, -73.55]]
@@ -0,0 +1,132 @@
+'''
+Trips files added while the app runs (data_years, DashApp.reload_data): the cached
+arrays updated with the new files are the same as a full rebuild
+
+python -m pytest tests
+'''
+
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import app_live  # noqa: E402
+import data_years  # noqa: E402
+from app import DashApp  # noqa: E402
+from data_years import AGGREGATES, TripsDataset  # noqa: E402
+
+NB_STATIONS = 30
+NB_TRIPS = 2000
+
+
+def write_stations(data_path, year: int, rng: np.random.Generator):
+    pd.DataFrame({
+        "code": np.arange(6000, 6000 + NB_STATIONS),
+        "name": [f"Station {idx}" for idx in range(NB_STATIONS)],
+        "latitude": 45.5 + rng.normal(0, 0.03, NB_STATIONS),
+        "longitude": -73.57 + rng.normal(0, 0.04, NB_STATIONS),
+    }).to_csv(data_path / f"Stations_{year}.csv", index=False)
+
+
+def write_month(data_path, year: int, month: int, rng: np.random.Generator):
+    '''
+    Trips of a month with the 2014-2020 schema (OD_<year>-<month>.csv)
+    '''
+    start = pd.Timestamp(year, month, 1) + pd.to_timedelta(rng.integers(0, 28 * 24 * 3600, NB_TRIPS), unit="s")
+    duration = rng.integers(60, 3600, NB_TRIPS)
+    pd.DataFrame({
+        "start_date": start,
+        "start_station_code": rng.integers(6000, 6000 + NB_STATIONS, NB_TRIPS),
+        "end_date": start + pd.to_timedelta(duration, unit="s"),
+        "end_station_code": rng.integers(6000, 6000 + NB_STATIONS, NB_TRIPS),
+        "duration_sec": duration,
+        "is_member": rng.integers(0, 2, NB_TRIPS),
+    }).to_csv(data_path / f"OD_{year}-{month:02}.csv", index=False, date_format="%Y-%m-%d %H:%M:%S")
+
+
+def write_data(data_path, years: dict):
+    '''
+    Write the stations and the trips files of {year: months}
+    '''
+    rng = np.random.default_rng(0)
+    data_path.mkdir(exist_ok=True)
+    for year, months in years.items():
+        write_stations(data_path, year, rng)
+        for month in months:
+            write_month(data_path, year, month, rng)
+
+
+def assert_same_arrays(dataset: TripsDataset, reference: TripsDataset, year: int):
+    for name in AGGREGATES[:2]:
+        np.testing.assert_array_equal(dataset.partitions[year].aggregate(name), reference.partitions[year].aggregate(name))
+    for origin, reference_origin in zip(dataset.partitions[year].od_pairs(), reference.partitions[year].od_pairs()):
+        np.testing.assert_array_equal(origin, reference_origin)
+    np.testing.assert_array_equal(dataset.month_counts(year), reference.month_counts(year))
+    np.testing.assert_array_equal(dataset.month_cube(year), reference.month_cube(year))
+    np.testing.assert_array_equal(dataset.time_cube(year), reference.time_cube(year))
+    np.testing.assert_array_equal(dataset.od_index(year).to_array(), reference.od_index(year).to_array())
+
+
+def test_reload_with_an_added_month(tmp_path):
+    data_path = tmp_path / "data"
+    write_data(data_path, {2018: [5, 6], 2019: [5, 6, 7]})
+    dash_app = DashApp(prewarm=False, live_path=None, data_path=str(data_path), watch=False)
+    # Arrays of 2019 used by the timeline filters, 2018 is never opened
+    dash_app.data.dataset.time_cube(2019)
+    cached = sorted(os.listdir(data_path / "cache"))
+    assert not any(name.startswith("2018_") for name in cached)
+
+    write_month(data_path, 2019, 11, np.random.default_rng(1))
+    write_month(data_path, 2018, 11, np.random.default_rng(2))
+    dash_app.reload_data()
+    dataset = dash_app.data.dataset
+    assert dataset.month_counts(2019)[11].sum() == NB_TRIPS
+
+    # Only the arrays already cached are updated, the partitions forget their counts
+    assert not any(name.startswith("2018_") for name in os.listdir(data_path / "cache"))
+    assert all(not partition._counts for partition in dataset.partitions.values())
+    for name in AGGREGATES:
+        assert dataset.partitions[2019].paths_to_count(name) is None
+
+    # Same arrays as a full rebuild from all the files
+    reference_path = tmp_path / "reference"
+    shutil.copytree(data_path, reference_path, ignore=shutil.ignore_patterns("cache"))
+    reference = TripsDataset(str(reference_path))
+    assert_same_arrays(dataset, reference, 2019)
+    assert_same_arrays(dataset, reference, 2018)
+
+
+def test_prepare_counts_the_files_once(tmp_path, monkeypatch):
+    data_path = tmp_path / "data"
+    write_data(data_path, {2019: [5, 6]})
+    dataset = TripsDataset(str(data_path))
+    partition = dataset.partitions[2019]
+
+    counted = []
+    count_files = partition.count_files
+
+    def count_files_spy(paths, *args, **kwargs):
+        if tuple(paths) not in partition._counts:
+            counted.append(list(paths))
+        return count_files(paths, *args, **kwargs)
+
+    monkeypatch.setattr(partition, "count_files", count_files_spy)
+    dataset.prepare()
+    assert counted == [partition.trips_paths]
+
+    write_month(data_path, 2019, 7, np.random.default_rng(1))
+    partition.trips_paths = sorted(partition.trips_paths + [str(data_path / "OD_2019-07.csv")])
+    dataset.prepare(cached_only=True)
+    assert counted == [partition.trips_paths[:2], [str(data_path / "OD_2019-07.csv")]]
+    assert not partition._counts
+
+
+def test_default_folders_of_the_app():
+    # Copied in app.py so the server starts before the data modules are imported
+    assert app.DATA_PATH == data_years.DATA_PATH
+    assert app.SNIFFER_PATH == app_live.SNIFFER_PATH
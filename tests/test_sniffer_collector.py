@@ -0,0 +1,112 @@
+'''
+Collector against the local stand-in GBFS server (sniffer_stand_in)
+
+python -m pytest tests
+'''
+
+import asyncio
+import os
+import sys
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sniffer_collector import Feed, GBFSCollector  # noqa: E402
+from sniffer_stand_in import StandInSystem, create_app  # noqa: E402
+
+
+async def fetch_feeds(app: web.Application, paths: list, nb_fetches: int, on_update=None, keep_etag: bool = True) -> list:
+    '''
+    Fetch nb_fetches times the feeds of the paths of app, returns the feeds
+    '''
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        feeds = [Feed(path, str(server.make_url(path)), on_update or (lambda feed, data: None)) for path in paths]
+        collector = GBFSCollector(feeds)
+        async with aiohttp.ClientSession() as session:
+            for _ in range(nb_fetches):
+                for feed in feeds:
+                    if not keep_etag:
+                        feed.etag = feed.last_modified = None
+                    await collector.fetch(session, feed)
+    finally:
+        await server.close()
+    return feeds
+
+
+def stand_in_app():
+    # The station status does not change during the test
+    return create_app([StandInSystem("bixi", 20, update_every=3600, ttl=10)])
+
+
+def test_etag_not_modified():
+    updates = []
+    feed, = asyncio.run(fetch_feeds(stand_in_app(), ["/bixi/fr/station_status.json"], 3, lambda feed, data: updates.append(data)))
+    assert feed.etag is not None
+    assert (feed.nb_requests, feed.nb_updates, feed.nb_unchanged, feed.nb_errors) == (3, 1, 2, 0)
+    assert len(updates) == 1 and len(updates[0]["data"]["stations"]) == 20
+
+
+def test_unchanged_payload_without_etag():
+    updates = []
+    feed, = asyncio.run(fetch_feeds(stand_in_app(), ["/bixi/fr/station_status.json"], 3, lambda feed, data: updates.append(data), keep_etag=False))
+    assert (feed.nb_requests, feed.nb_updates, feed.nb_unchanged, feed.nb_errors) == (3, 1, 2, 0)
+    assert len(updates) == 1
+
+
+def test_bad_payload_and_update_error_keep_polling():
+    app = stand_in_app()
+
+    async def html_page(request):
+        return web.Response(text="<html>Service unavailable</html>", content_type="text/html")
+
+    app.router.add_get("/broken/fr/station_status.json", html_page)
+
+    def on_update(feed, data):
+        if feed.nb_errors == 0 and feed.name == "/bixi/fr/station_information.json":
+            raise ValueError("failing update")
+
+    broken, status, information = asyncio.run(fetch_feeds(
+        app, ["/broken/fr/station_status.json", "/bixi/fr/station_status.json", "/bixi/fr/station_information.json"], 3, on_update
+    ))
+    assert (broken.nb_requests, broken.nb_updates, broken.nb_errors) == (3, 0, 3)
+    assert (status.nb_updates, status.nb_unchanged, status.nb_errors) == (1, 2, 0)
+    # The failed update is handled again at the next request
+    assert (information.nb_updates, information.nb_unchanged, information.nb_errors) == (1, 1, 1)
+
+
+def test_run_with_a_broken_feed():
+    '''
+    An infinite collect is not stopped by a feed returning html
+    '''
+    async def collect():
+        app = stand_in_app()
+
+        async def html_page(request):
+            return web.Response(text="<html></html>", content_type="text/html")
+
+        app.router.add_get("/broken/fr/station_status.json", html_page)
+        server = TestServer(app)
+        await server.start_server()
+        feeds = [
+            Feed(path, str(server.make_url(path)), lambda feed, data: None, min_interval=0.05)
+            for path in ["/broken/fr/station_status.json", "/bixi/fr/station_status.json"]
+        ]
+        try:
+            # Still collecting at the timeout
+            await asyncio.wait_for(GBFSCollector(feeds).run(0), timeout=0.5)
+            stopped = True
+        except asyncio.TimeoutError:
+            stopped = False
+        finally:
+            await server.close()
+        return stopped, feeds
+
+    stopped, (broken, status) = asyncio.run(collect())
+    assert not stopped
+    assert broken.nb_errors >= 3 and broken.nb_errors == broken.nb_requests
+    assert status.nb_updates == 1
@@ -0,0 +1,52 @@
+'''
+Decoding of the GBFS station_status payloads (sniffer_parsing)
+
+python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sniffer_parsing import StationIds, decode_station_status  # noqa: E402
+
+
+def payload(station_ids: list, last_updated: int = 1_700_000_000) -> dict:
+    return {
+        "last_updated": last_updated,
+        "data": {"stations": [
+            {"station_id": station_id, "num_bikes_available": i, "num_docks_available": 10 - i,
+             "is_renting": 1, "is_returning": 1, "last_reported": last_updated - i}
+            for i, station_id in enumerate(station_ids)
+        ]},
+    }
+
+
+def test_numeric_ids_keep_their_value():
+    columns = decode_station_status(payload(["12", "7", 3]))
+    assert columns["station_id"].tolist() == [12, 7, 3]
+    assert columns["ebikes"].tolist() == [0, 0, 0]
+
+
+def test_string_ids_are_stored_as_integers(tmp_path):
+    path = str(tmp_path / "station_ids.json")
+    station_ids = StationIds(path)
+    first = decode_station_status(payload(["a1b2-station", "5", "other"]), station_ids)["station_id"]
+    assert first.dtype == np.int32
+    assert len(set(first.tolist())) == 3 and first[1] == 5
+
+    # Same integers in the next payloads and after a restart of the sniffer
+    second = decode_station_status(payload(["other", "a1b2-station", "new"]), station_ids)["station_id"]
+    assert second[:2].tolist() == [first[2], first[0]]
+    assert StationIds(path).lookup(["a1b2-station", "5", "other", "new", "unknown"]).tolist() == [
+        first[0], 5, first[2], second[2], -1
+    ]
+
+
+def test_numeric_id_of_a_used_integer():
+    station_ids = StationIds()
+    station_ids.encode(["x", "y"])
+    assert station_ids.encode(["1", "0", "x"]).tolist() == [2, 3, 0]
@@ -0,0 +1,21 @@
+"""
+Entry point to serve the app with several worker processes behind a WSGI server:
+
+    python data_pipeline.py --processes 4
+    gunicorn --workers 4 --preload wsgi:server
+
+data_pipeline.py builds the arrays of all the years once (data/cache). The workers only
+memory-map these files read-only, so they share the same pages: adding workers does
+not multiply the memory used by the data nor the start time.
+With --preload the app is also created once in the master process before the workers
+are forked, so the data is loaded before the fork (not lazily in a thread, the thread
+would not be in the workers).
+Each worker watches the data folder: trips files added later are merged into the
+cached arrays (only the new files are parsed) and swapped in without restart.
+"""
+
+from app import DashApp
+
+# Each worker has its own figure caches, they are filled by the requests
+dash_app = DashApp(prewarm=False)
+server = dash_app.app.server